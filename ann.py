@@ -0,0 +1,240 @@
+import argparse
+import os
+
+import numpy as np
+
+import embeddings
+import search
+
+DATA_PATH = 'data'
+
+NLIST_DEFAULT = 1024
+NPROBE_DEFAULT = 32
+KMEANS_ITER = 20
+KMEANS_SAMPLE = 100000
+# rows assigned to centroids at once, bounds the (rows x nlist) score matrix
+ASSIGN_BATCH = 65536
+
+
+def index_path(embeds_path):
+    """
+    Index file stored next to the embeddings,
+    e.g. data/scibert-nli-embeddings.pkl -> data/scibert-nli-ivf.npz
+    """
+    base = os.path.splitext(embeds_path)[0]
+    if base.endswith('-embeddings'):
+        base = base[:-len('-embeddings')]
+    return base + '-ivf.npz'
+
+
+def cluster_sums(data, assign, k):
+    """
+    Per-cluster sums and sizes, one sorted reduction instead of a slow
+    unbuffered np.add.at scatter.
+    """
+    order = np.argsort(assign, kind='stable')
+    counts = np.bincount(assign, minlength=k)
+    sums = np.zeros((k, data.shape[1]), dtype=np.float32)
+    nonempty = counts > 0
+    starts = (np.cumsum(counts) - counts)[nonempty]
+    sums[nonempty] = np.add.reduceat(data[order], starts, axis=0)
+    return sums, counts
+
+
+class ExactIndex(object):
+    """
+    Brute-force scan over all embeddings, always exact.
+    """
+
+    def __init__(self, embeds):
+        self.embeds = embeds
+
+    def iter_search(self, query_embed, k, mask=None):
+        return search.iter_search(self.embeds, query_embed, k, mask)
+
+    def iter_search_batch(self, query_embeds, ks, masks):
+        # one matrix-matrix product scores the queries of the batch over all
+        # rows, those with a sparse mask only score their rows on their own
+        sparse = len(self.embeds) * search.SPARSE_MASK
+        dense = [i for i, mask in enumerate(masks)
+                 if mask is None or np.count_nonzero(mask) >= sparse]
+        scores = [None] * len(masks)
+        if dense:
+            batch_scores = search.similarity_batch(
+                self.embeds, np.asarray(query_embeds)[dense])
+            for i, query_scores in zip(dense, batch_scores):
+                scores[i] = query_scores
+        return [
+            search.iter_search(self.embeds, query_embed, k, mask, query_scores)
+            for query_embed, k, mask, query_scores
+            in zip(query_embeds, ks, masks, scores)
+        ]
+
+
+class IVFIndex(object):
+    """
+    Inverted file index: embeddings are clustered with spherical k-means and
+    a query only scans the rows of the nprobe closest clusters. Raising
+    nprobe trades latency for recall, nprobe == nlist is an exact scan.
+    """
+
+    def __init__(self, embeds, centroids, order, offsets, nprobe=NPROBE_DEFAULT):
+        self.embeds = embeds
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = nprobe
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, embeds, nlist=NLIST_DEFAULT, n_iter=KMEANS_ITER,
+              sample=KMEANS_SAMPLE, nprobe=NPROBE_DEFAULT, seed=0):
+        rng = np.random.default_rng(seed)
+        nlist = max(1, min(nlist, len(embeds)))
+        if len(embeds) > sample:
+            train = embeds[np.sort(rng.choice(len(embeds), sample, replace=False))]
+        else:
+            train = embeds
+        train = np.asarray(train, dtype=np.float32)
+        centroids = train[rng.choice(len(train), nlist, replace=False)].copy()
+        for _ in range(n_iter):
+            assign = IVFIndex._assign(train, centroids)
+            sums, counts = cluster_sums(train, assign, nlist)
+            # re-seed empty clusters with random training rows
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = train[rng.choice(len(train), empty.sum())]
+            centroids = search.normalize(sums)
+        return cls.from_centroids(embeds, centroids, nprobe)
+
+    @classmethod
+    def from_centroids(cls, embeds, centroids, nprobe=NPROBE_DEFAULT):
+        """
+        Bucket embeddings under already trained centroids, e.g. to update the
+        index after an incremental ingest without re-running k-means.
+        """
+        nlist = len(centroids)
+        assign = IVFIndex._assign(embeds, centroids)
+        order = np.argsort(assign, kind='stable').astype(np.int64)
+        counts = np.bincount(assign, minlength=nlist)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(embeds, centroids, order, offsets, nprobe)
+
+    @staticmethod
+    def _assign(embeds, centroids):
+        assign = np.empty(len(embeds), dtype=np.int64)
+        for start in range(0, len(embeds), ASSIGN_BATCH):
+            batch = np.asarray(embeds[start:start + ASSIGN_BATCH], dtype=np.float32)
+            assign[start:start + len(batch)] = np.argmax(
+                batch @ centroids.T, axis=1)
+        return assign
+
+    def _candidates(self, lists):
+        return np.concatenate([
+            self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists
+        ])
+
+    def iter_search(self, query_embed, k, mask=None, nprobe=None):
+        """
+        Yield (idx, score) best first. Rows are pooled over the probed
+        clusters and the k best of the pool yielded; when the caller consumes
+        more, more clusters are probed into what is left of the pool before
+        the next selection. The first k rows are the best of at least nprobe
+        clusters. A mask selecting fewer rows than the probed clusters would
+        hold is searched exactly.
+        """
+        nprobe = nprobe or self.nprobe
+        if mask is not None and \
+                np.count_nonzero(mask) <= len(self.embeds) * nprobe / self.nlist:
+            yield from search.iter_search(self.embeds, query_embed, k, mask)
+            return
+        list_order = search.top_k(self.centroids @ query_embed, self.nlist)
+        k = max(k, 1)
+        probed = 0
+        # probed rows not yielded yet
+        rows = np.empty(0, dtype=np.int64)
+        scores = np.empty(0, dtype=np.float32)
+        while True:
+            while (probed == 0 or len(rows) < k) and probed < self.nlist:
+                lists = list_order[probed:max(nprobe, probed + 1)]
+                probed += len(lists)
+                nprobe *= 2
+                candidates = self._candidates(lists)
+                if mask is not None:
+                    candidates = candidates[mask[candidates]]
+                rows = np.concatenate((rows, candidates))
+                scores = np.concatenate((scores, search.similarity(
+                    self.embeds[candidates], query_embed)))
+            if probed >= self.nlist:
+                for i in search.iter_top_k(scores, k):
+                    yield int(rows[i]), float(scores[i])
+                return
+            best = search.top_k(scores, k)
+            for i in best:
+                yield int(rows[i]), float(scores[i])
+            rest = np.ones(len(rows), dtype=bool)
+            rest[best] = False
+            rows, scores = rows[rest], scores[rest]
+            k *= search.GROWTH_FACTOR
+
+    def iter_search_batch(self, query_embeds, ks, masks):
+        # every query probes its own clusters
+        return [
+            self.iter_search(query_embed, k, mask)
+            for query_embed, k, mask in zip(query_embeds, ks, masks)
+        ]
+
+    def save(self, path):
+        # write through a temp file so a running reader never sees a partial index
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path,
+                 centroids=self.centroids,
+                 order=self.order,
+                 offsets=self.offsets)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, embeds, nprobe=NPROBE_DEFAULT):
+        data = np.load(path)
+        if data['offsets'][-1] != len(embeds):
+            raise ValueError(f'Index "{path}" does not match the embeddings.')
+        return cls(embeds, data['centroids'], data['order'], data['offsets'],
+                   nprobe)
+
+
+def load_index(embeds, path=None, nprobe=NPROBE_DEFAULT):
+    """
+    IVF index if one was built for these embeddings, exact scan otherwise.
+    """
+    if path is not None and os.path.exists(path):
+        return IVFIndex.load(path, embeds, nprobe)
+    return ExactIndex(embeds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build an IVF index next to the model embeddings.')
+    parser.add_argument('--model', default='scibert-nli', type=str)
+    parser.add_argument('--nlist', default=NLIST_DEFAULT, type=int,
+                        help='Number of k-means clusters.')
+    parser.add_argument('--iter', default=KMEANS_ITER, type=int,
+                        help='Number of k-means iterations.')
+    parser.add_argument('--sample', default=KMEANS_SAMPLE, type=int,
+                        help='Number of rows used to train the clusters.')
+    args = parser.parse_args()
+
+    embeds_path = os.path.join(DATA_PATH, f'{args.model}-embeddings.pkl')
+    # ingest only writes the .npy store, a pickle left next to it is stale
+    if os.path.exists(embeddings.npy_path(embeds_path)):
+        embeds_path = embeddings.npy_path(embeds_path)
+    print(f'Load embeddings from "{embeds_path}"...')
+    embeds = embeddings.load(embeds_path)
+    print(f'Build index with {args.nlist} lists over {len(embeds)} rows...')
+    index = IVFIndex.build(embeds, args.nlist, args.iter, args.sample)
+    path = index_path(embeds_path)
+    index.save(path)
+    print('Index available in', path)
@@ -0,0 +1,123 @@
+import contextvars
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+MAX_BATCH_SIZE = 32
+# seconds the first question of a batch waits for others to join
+MAX_WAIT = 0.005
+TOP_K_DEFAULT = 20
+MODE_DEFAULT = 'semantic'
+
+# futures of the questions submitted by the current request, None outside
+_submitted = contextvars.ContextVar('submitted', default=None)
+
+
+@contextmanager
+def tracking():
+    """
+    Collect the futures of the questions submitted within (also from a
+    context copied inside), so the caller can cancel those not batched yet,
+    e.g. when its client went away.
+    """
+    futures = []
+    token = _submitted.set(futures)
+    try:
+        yield futures
+    finally:
+        _submitted.reset(token)
+
+
+class MicroBatcher(object):
+    """
+    Coalesces questions of concurrent requests into batches. A single
+    background thread collects the questions that arrive within max_wait of
+    the first one (up to max_batch_size), answers them with one call to
+    engine.ask_questions and hands each result back to its waiting caller.
+    When the batch fails its questions are asked one by one, so an error
+    only reaches the callers whose question caused it.
+
+    Drop-in replacement for the engine: everything except ask_question is
+    forwarded to it.
+    """
+
+    def __init__(self, engine, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT,
+                 top_k=TOP_K_DEFAULT):
+        self.engine = engine
+        self.top_k = top_k
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._start()
+        # threads don't survive fork(), pre-forked workers need their own
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run,
+                                       name='micro-batcher',
+                                       daemon=True)
+        self.worker.start()
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def submit(self, query, filters={}, top_k=None, mode=MODE_DEFAULT,
+               offset=0, model=None):
+        future = Future()
+        futures = _submitted.get()
+        if futures is not None:
+            futures.append(future)
+        if top_k is None:
+            top_k = self.top_k
+        self.queue.put(((query, filters, top_k, mode, offset, model), future))
+        return future
+
+    def ask_question(self, query, filters={}, top_k=None, mode=MODE_DEFAULT,
+                     offset=0, model=None, timeout=None):
+        return self.submit(query, filters, top_k, mode, offset,
+                           model).result(timeout)
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # callers that gave up (cancelled) are not answered
+            batch = [(question, future) for question, future in batch
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                answers = self.engine.ask_questions(
+                    [question for question, _ in batch])
+            except Exception as ex:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(ex)
+                    continue
+                # one bad question (e.g. for a model that isn't available)
+                # must not fail the others: answer them one by one
+                for question, future in batch:
+                    try:
+                        answer, = self.engine.ask_questions([question])
+                    except Exception as ex:
+                        future.set_exception(ex)
+                    else:
+                        future.set_result(answer)
+                continue
+            for (_, future), answer in zip(batch, answers):
+                future.set_result(answer)
@@ -0,0 +1,343 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import ann
+import batching
+import corpus
+import lexical
+import papers
+import render
+import search
+
+BENCH_PATH = os.path.join('data', 'bench')
+SIZES = (10000, 100000, 1000000)
+DIM = 768
+# rows generated and written at once
+GENERATE_CHUNK = 50000
+ABSTRACT_WORDS = 120
+TITLE_WORDS = 10
+# fake metadata, languages skewed like the real corpus so filters on the
+# rare ones select few rows
+LANGS = ('en', 'es', 'fr', 'de', 'zh', None)
+LANG_WEIGHTS = (0.86, 0.04, 0.03, 0.02, 0.02, 0.03)
+THEMES = ('Epidemiology', 'Treatment', 'Virology', 'Diagnosis',
+          'Public health', None)
+SUB_THEMES = ('Transmission', 'Vaccines', 'Drugs', 'Genome', 'Testing',
+              'Mortality', None)
+VOCABULARY_SIZE = 20000
+QUERY_WORDS = 4
+
+
+def vocabulary(size=VOCABULARY_SIZE, seed=0):
+    """
+    Pronounceable fake words; a few of the real ones so queries hit.
+    """
+    rng = np.random.default_rng(seed)
+    consonants = list('bcdfghklmnprstvz')
+    vowels = list('aeiou')
+    words = {'covid-19', 'sars-cov-2', 'ace2', 'il-6', 'incubation',
+             'transmission', 'vaccine', 'mortality'}
+    while len(words) < size:
+        n = rng.integers(2, 5)
+        words.add(''.join(rng.choice(consonants) + rng.choice(vowels)
+                          for _ in range(n)))
+    return np.array(sorted(words))
+
+
+def text(rng, words, rows, length):
+    ids = rng.zipf(1.3, size=(rows, length)) % len(words)
+    return [' '.join(row) for row in words[ids]]
+
+
+def pick(rng, values, rows, p=None):
+    return [values[i] for i in rng.choice(len(values), rows, p=p)]
+
+
+def generate(path, size, dim=DIM, seed=0):
+    """
+    Synthetic corpus store and normalized embeddings in path/corpus and
+    path/embeddings.npy, rows following the corpus.pkl schema. Reused if
+    already generated with the same size.
+    """
+    corpus_path = os.path.join(path, 'corpus')
+    embeds_path = os.path.join(path, 'embeddings.npy')
+    if corpus.exists(corpus_path) and os.path.exists(embeds_path):
+        embeds = np.load(embeds_path, mmap_mode='r')
+        if embeds.shape == (size, dim) and len(corpus.load(corpus_path)) == size:
+            return corpus_path, embeds_path
+    os.makedirs(path, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    words = vocabulary(seed=seed)
+    writer = corpus.CorpusWriter(corpus_path)
+    tmp_path = embeds_path + '.tmp'
+    embeds = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                       shape=(size, dim))
+    for start in range(0, size, GENERATE_CHUNK):
+        rows = min(GENERATE_CHUNK, size - start)
+        years = rng.integers(2000, 2021, rows)
+        writer.append({
+            'abstract': text(rng, words, rows, ABSTRACT_WORDS),
+            'date': [f'{year}-{rng.integers(1, 13):02d}-{rng.integers(1, 29):02d}'
+                     for year in years],
+            'lang': pick(rng, LANGS, rows, LANG_WEIGHTS),
+            'title': text(rng, words, rows, TITLE_WORDS),
+            'url': [f'https://example.org/paper/{start + i}' for i in range(rows)],
+            'theme': pick(rng, THEMES, rows),
+            'sub_theme': pick(rng, SUB_THEMES, rows),
+            'cord_uid': [f'{start + i:08x}' for i in range(rows)],
+        })
+        embeds[start:start + rows] = search.normalize(
+            rng.standard_normal((rows, dim), dtype=np.float32))
+        print(f'Generated {start + rows}/{size} rows')
+    writer.close()
+    embeds.flush()
+    del embeds
+    os.replace(tmp_path, embeds_path)
+    return corpus_path, embeds_path
+
+
+class StubEncoder(object):
+    """
+    Stands in for the SentenceTransformer: a fixed random vector per query,
+    plus an optional fixed delay per batch to model the encoding cost.
+    """
+
+    def __init__(self, dim=DIM, delay=0):
+        self.dim = dim
+        self.delay = delay
+
+    def encode(self, queries, show_progress_bar=False, **kwargs):
+        if self.delay:
+            time.sleep(self.delay)
+        return np.stack([
+            np.random.default_rng(zlib.crc32(query.encode('utf-8')))
+            .standard_normal(self.dim, dtype=np.float32)
+            for query in queries
+        ])
+
+
+class BenchEngine(papers.AnswerEngine):
+
+    def __init__(self, corpus_path, embeds_path, index_path=None, stub=None):
+        super().__init__(corpus_path, None, embeds_path, index_path)
+        self.stub = stub
+
+    def load_model(self, model_path):
+        return self.stub
+
+
+def memory():
+    """
+    Resident and peak resident memory in MB.
+    """
+    usage = {'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    usage['rss_mb'] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return {name: round(value, 1) for name, value in usage.items()}
+
+
+def percentiles(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {
+        'count': len(ms),
+        'mean_ms': round(float(ms.mean()), 3),
+        'p50_ms': round(float(np.percentile(ms, 50)), 3),
+        'p90_ms': round(float(np.percentile(ms, 90)), 3),
+        'p99_ms': round(float(np.percentile(ms, 99)), 3),
+        'max_ms': round(float(ms.max()), 3),
+    }
+
+
+class Queries(object):
+    """
+    Never repeating queries made of corpus words, so every measured
+    question misses the caches unless asked again on purpose.
+    """
+
+    def __init__(self, seed=1):
+        self.rng = np.random.default_rng(seed)
+        self.words = vocabulary()
+        self.count = 0
+
+    def __call__(self, n):
+        queries = []
+        for _ in range(n):
+            self.count += 1
+            words = self.rng.choice(self.words[:2000], QUERY_WORDS)
+            queries.append(' '.join(words) + f' {self.count}')
+        return queries
+
+
+def answer(engine, query, filters={}, limit=papers.RETURN_DEFAULT,
+           mode='semantic'):
+    """
+    What a /papers request does, minus HTTP: rank, render and serialize.
+    """
+    results = engine.ask_question(query, filters, limit, mode)
+    return render.dumps({
+        'query': query,
+        **papers.page_info(0, limit, results),
+        **engine.format_results(results),
+    })
+
+
+def latency(engine, queries, **kwargs):
+    seconds = []
+    for query in queries:
+        start = time.perf_counter()
+        answer(engine, query, **kwargs)
+        seconds.append(time.perf_counter() - start)
+    return percentiles(seconds)
+
+
+def throughput(engine, queries, concurrency):
+    batcher = batching.MicroBatcher(engine, top_k=papers.RETURN_DEFAULT)
+
+    def ask(query):
+        results = batcher.ask_question(query)
+        return render.dumps(engine.format_results(results))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(ask, queries))
+    elapsed = time.perf_counter() - start
+    return {
+        'concurrency': concurrency,
+        'queries': len(queries),
+        'seconds': round(elapsed, 3),
+        'qps': round(len(queries) / elapsed, 1),
+    }
+
+
+def run(size, args):
+    print(f'--- {size} rows ---')
+    path = os.path.join(args.work_dir, f'{size}-{args.dim}')
+    start = time.perf_counter()
+    corpus_path, embeds_path = generate(path, size, args.dim)
+    report = {
+        'size': size,
+        'dim': args.dim,
+        'generate_s': round(time.perf_counter() - start, 3),
+    }
+
+    index_path = None
+    if args.ivf:
+        index_path = ann.index_path(embeds_path)
+        if not os.path.exists(index_path):
+            print('Build IVF index...')
+            ann.IVFIndex.build(np.load(embeds_path, mmap_mode='r'),
+                               args.nlist).save(index_path)
+    if args.lexical and not os.path.exists(lexical.index_path(corpus_path)):
+        print('Build BM25 index...')
+        start = time.perf_counter()
+        lexical.build(corpus_path)
+        report['build_bm25_s'] = round(time.perf_counter() - start, 3)
+
+    engine = BenchEngine(corpus_path, embeds_path, index_path,
+                         StubEncoder(args.dim, args.encode_ms / 1000))
+    start = time.perf_counter()
+    if not engine.load(warmup=()):
+        raise SystemExit(f'Loading failed: {engine.error}')
+    report['load_s'] = round(time.perf_counter() - start, 3)
+    report['memory_after_load'] = memory()
+
+    queries = Queries()
+    start = time.perf_counter()
+    engine.warmup(papers.WARMUP_QUERIES)
+    report['warmup_s'] = round(time.perf_counter() - start, 3)
+
+    cases = {
+        'semantic': {},
+        'filtered_lang': {'filters': {'lang': ['de']}},
+        'filtered_year': {'filters': {'year_min': 2020, 'year_max': 2020}},
+        'filtered_combined': {'filters': {'lang': ['zh'],
+                                          'theme': ['Virology'],
+                                          'year_min': 2019}},
+        'deep_page': {'limit': 200},
+    }
+    if engine.data.lexical is not None:
+        cases['lexical'] = {'mode': 'lexical'}
+        cases['hybrid'] = {'mode': 'hybrid'}
+    report['latency'] = {
+        name: latency(engine, queries(args.queries), **kwargs)
+        for name, kwargs in cases.items()
+    }
+    repeated = queries(args.queries)
+    latency(engine, repeated)
+    report['latency']['cached'] = latency(engine, repeated)
+
+    report['throughput'] = [
+        throughput(engine, queries(args.queries * concurrency), concurrency)
+        for concurrency in args.concurrency
+    ]
+    report['memory'] = memory()
+    for name, stats in report['latency'].items():
+        print(f'{name:18} p50 {stats["p50_ms"]:9.3f} ms  '
+              f'p99 {stats["p99_ms"]:9.3f} ms')
+    for stats in report['throughput']:
+        print(f'concurrency {stats["concurrency"]:3d}  {stats["qps"]:9.1f} q/s')
+    return report
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the answer engine on synthetic corpora with a '
+                    'stub encoder, results as JSON.')
+    parser.add_argument('--sizes', nargs='+', default=SIZES, type=int)
+    parser.add_argument('--dim', default=DIM, type=int)
+    parser.add_argument('--queries', default=200, type=int,
+                        help='Questions per latency measurement.')
+    parser.add_argument('--concurrency', nargs='+', default=(1, 4, 16), type=int)
+    parser.add_argument('--encode_ms', default=0, type=float,
+                        help='Simulated encoder time per batch.')
+    parser.add_argument('--ivf', action='store_true',
+                        help='Search an IVF index instead of the exact scan.')
+    parser.add_argument('--nlist', default=ann.NLIST_DEFAULT, type=int)
+    parser.add_argument('--lexical', action='store_true',
+                        help='Build the BM25 index and measure lexical/hybrid.')
+    parser.add_argument('--work_dir', default=BENCH_PATH, type=str)
+    parser.add_argument('--output', default=None, type=str,
+                        help='JSON file to write (default: stdout).')
+    args = parser.parse_args()
+
+    results = {
+        'commit': commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpus': os.cpu_count(),
+        'args': vars(args),
+        'runs': [run(size, args) for size in args.sizes],
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results written to', args.output)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
@@ -0,0 +1,203 @@
+import argparse
+import json
+import multiprocessing
+import os
+from shutil import rmtree
+
+import numpy as np
+
+import ann
+import corpus
+import dedup
+import embeddings
+import passages
+import quantize
+import search
+
+DATA_PATH = 'data'
+MODELS_PATH = 'models'
+CORPUS_PATH = os.path.join(DATA_PATH, 'corpus.pkl')
+
+CHUNK_SIZE = 2048
+BATCH_SIZE = 32
+
+# set in every pool process by init_worker
+worker_corpus = None
+worker_model = None
+worker_parts = None
+
+
+def parts_path(path):
+    return path + '.parts'
+
+
+def chunk_path(parts, chunk_id):
+    return os.path.join(parts, f'chunk-{chunk_id:06d}.npy')
+
+
+def length_order(store):
+    """
+    Row ids sorted by abstract length, so each chunk holds texts of similar
+    length and batches need little padding. The utf-8 byte length comes for
+    free from the column offsets and is a good proxy for the token count.
+    """
+    lengths = np.diff(store.offsets['abstract'])
+    return np.argsort(lengths, kind='stable').astype(np.int64)
+
+
+def prepare(parts, path, store, model_path, chunk_size):
+    """
+    Set up the checkpoint directory, or reuse it if it belongs to the same
+    build so already encoded chunks are skipped.
+    """
+    manifest = {
+        'output': os.path.abspath(path),
+        'corpus': os.path.abspath(store.path),
+        'size': len(store),
+        'model': os.path.abspath(model_path),
+        'chunk_size': chunk_size,
+    }
+    manifest_path = os.path.join(parts, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) == manifest:
+                return np.load(os.path.join(parts, 'order.npy'))
+        print('Checkpoints belong to another build, starting over.')
+        rmtree(parts)
+    os.makedirs(parts, exist_ok=True)
+    order = length_order(store)
+    np.save(os.path.join(parts, 'order.npy'), order)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return order
+
+
+def init_worker(corpus_path, model_path, parts, threads):
+    global worker_corpus, worker_model, worker_parts
+    import torch
+    from sentence_transformers import SentenceTransformer
+    torch.set_num_threads(threads)
+    worker_corpus = corpus.load(corpus_path)
+    worker_model = SentenceTransformer(model_path)
+    worker_parts = parts
+
+
+def encode_chunk(args):
+    chunk_id, ids, batch_size = args
+    texts = [worker_corpus.get('abstract', idx) or '' for idx in ids]
+    embeds = worker_model.encode(texts, batch_size=batch_size,
+                                 show_progress_bar=False)
+    path = chunk_path(worker_parts, chunk_id)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, search.normalize(embeds))
+    os.replace(tmp_path, path)
+    return chunk_id
+
+
+def assemble(path, parts, order, chunk_size, dtype):
+    """
+    Scatter the chunk checkpoints back into corpus order, directly into a
+    memory-mapped output file.
+    """
+    first = np.load(chunk_path(parts, 0), mmap_mode='r')
+    tmp_path = path + '.tmp'
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype,
+                                    shape=(len(order), first.shape[1]))
+    for chunk_id, start in enumerate(range(0, len(order), chunk_size)):
+        ids = order[start:start + chunk_size]
+        out[ids] = np.load(chunk_path(parts, chunk_id)).astype(dtype)
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+
+
+def update_stores(corpus_path, model_path, path):
+    """
+    Bring the stores derived from the embeddings (near-duplicates, IVF
+    index, compressed codes, passages) in line with the new ones, as a full
+    ingest does; those that don't exist yet are left out.
+    """
+    if os.path.exists(dedup.index_path(corpus_path)):
+        print('Cluster near-duplicates...')
+        dedup.build(corpus_path, path)
+    index_path = ann.index_path(path)
+    if os.path.exists(index_path):
+        # trained in the previous model's space
+        print('Retrain index...')
+        nlist = len(np.load(index_path)['centroids'])
+        ann.IVFIndex.build(embeddings.load(path), nlist).save(index_path)
+    for mode in quantize.MODES:
+        codes_path = quantize.codes_path(path, mode)
+        if os.path.exists(codes_path):
+            print(f'Update {mode} codes...')
+            quantize.save(codes_path, quantize.train(embeddings.load(path), mode))
+    if passages.exists(path):
+        print('Update passages...')
+        passages.build(corpus.load(corpus_path), model_path).save(path)
+
+
+def build(corpus_path, model_path, path, workers=None, threads=None,
+          chunk_size=CHUNK_SIZE, batch_size=BATCH_SIZE, dtype='float32'):
+    """
+    Encode every abstract of the corpus into the .npy embedding store at
+    `path`. Chunks of length-sorted abstracts are spread over a pool of
+    processes, each chunk is checkpointed, and an interrupted build picks up
+    where it stopped when called again. The stores derived from the
+    embeddings are rebuilt afterwards.
+    """
+    store = corpus.load(corpus_path)
+    if not len(store):
+        raise ValueError('The corpus is empty.')
+    parts = parts_path(path)
+    order = prepare(parts, path, store, model_path, chunk_size)
+    chunks = [
+        (chunk_id, order[start:start + chunk_size], batch_size)
+        for chunk_id, start in enumerate(range(0, len(order), chunk_size))
+    ]
+    todo = [chunk for chunk in chunks
+            if not os.path.exists(chunk_path(parts, chunk[0]))]
+    print(f'{len(chunks) - len(todo)} of {len(chunks)} chunks already encoded.')
+
+    if todo:
+        workers = workers or os.cpu_count() or 1
+        threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        # spawn: torch's thread pools don't survive fork()
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(workers, init_worker,
+                          (store.path, model_path, parts, threads)) as pool:
+            for done, chunk_id in enumerate(
+                    pool.imap_unordered(encode_chunk, todo), 1):
+                print(f'Encoded chunk {chunk_id} ({done}/{len(todo)})')
+
+    print(f'Assemble embeddings into "{path}"...')
+    assemble(path, parts, order, chunk_size, dtype)
+    rmtree(parts)
+    update_stores(corpus_path, model_path, path)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Encode the corpus into the embedding store, in parallel '
+                    'and resumable.')
+    parser.add_argument('--model', default='scibert-nli', type=str)
+    parser.add_argument('--workers', default=None, type=int,
+                        help='Encoding processes (default: number of CPUs).')
+    parser.add_argument('--threads', default=None, type=int,
+                        help='Torch threads per process (default: CPUs / workers).')
+    parser.add_argument('--chunk_size', default=CHUNK_SIZE, type=int)
+    parser.add_argument('--batch_size', default=BATCH_SIZE, type=int)
+    parser.add_argument('--dtype', default='float32', choices=embeddings.DTYPES)
+    args = parser.parse_args()
+
+    path = os.path.join(DATA_PATH, f'{args.model}-embeddings.npy')
+    build(CORPUS_PATH,
+          os.path.join(MODELS_PATH, args.model),
+          path,
+          args.workers,
+          args.threads,
+          args.chunk_size,
+          args.batch_size,
+          args.dtype)
+    print('Embeddings available in', path)
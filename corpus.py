@@ -0,0 +1,344 @@
+import argparse
+import json
+import os
+import pickle
+import re
+from shutil import rmtree
+
+import numpy as np
+
+DATA_PATH = 'data'
+CORPUS_PATH = os.path.join(DATA_PATH, 'corpus.pkl')
+
+VERSION = 2
+
+# order of the fields in the legacy corpus.pkl rows
+FIELDS = ('abstract', 'date', 'lang', 'title', 'url', 'theme', 'sub_theme',
+          'cord_uid')
+# utf-8 bytes buffer + int64 offsets + validity mask; the date is kept as
+# written for the responses, its DATE_COLUMNS copy is for the filters
+STRING_COLUMNS = ('abstract', 'title', 'url', 'cord_uid', 'date')
+# int16 codes into a list of categories, -1 is null
+CATEGORY_COLUMNS = ('lang', 'theme', 'sub_theme')
+# int32 YYYYMMDD, month/day 00 if unknown, 0 is null
+DATE_COLUMNS = ('date',)
+
+# 2020, 2020-03, 2020-03-15, 2020 Mar, 2020 Mar 15
+DATE_RE = re.compile(
+    r'^\s*(\d{4})(?:[-\s]+(\d{1,2}|[A-Za-z]{3})[A-Za-z]*(?:[-\s]+(\d{1,2}))?)?')
+MONTHS = ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep',
+          'oct', 'nov', 'dec')
+
+
+def is_null(data):
+    return data is None or data != data
+
+
+def parse_date(date):
+    if is_null(date):
+        return 0
+    match = DATE_RE.match(str(date))
+    if match is None:
+        return 0
+    year, month, day = match.groups()
+    if month and not month.isdigit():
+        month = MONTHS.index(month.lower()) + 1 if month.lower() in MONTHS else 0
+    return int(year) * 10000 + int(month or 0) * 100 + int(day or 0)
+
+
+def format_date(value):
+    if value == 0:
+        return None
+    year, month, day = value // 10000, value // 100 % 100, value % 100
+    if month == 0:
+        return f'{year:04d}'
+    if day == 0:
+        return f'{year:04d}-{month:02d}'
+    return f'{year:04d}-{month:02d}-{day:02d}'
+
+
+class CorpusWriter(object):
+    """
+    Writes a columnar corpus store chunk by chunk. String bytes are streamed
+    to disk as they come, only offsets and small per-row arrays are kept in
+    memory until close().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        if os.path.exists(self.tmp_path):
+            rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+        self.size = 0
+        self.data = {}
+        self.lengths = {name: [] for name in STRING_COLUMNS}
+        self.valid = {name: [] for name in STRING_COLUMNS}
+        self.codes = {name: [] for name in CATEGORY_COLUMNS}
+        self.categories = {name: {} for name in CATEGORY_COLUMNS}
+        self.dates = {name: [] for name in DATE_COLUMNS}
+        for name in STRING_COLUMNS:
+            self.data[name] = open(self._file(name, 'bin'), 'wb')
+
+    def _file(self, name, ext):
+        return os.path.join(self.tmp_path, f'{name}.{ext}')
+
+    def append(self, columns):
+        """
+        Append a chunk given as {field: sequence of values}, all sequences of
+        the same length.
+        """
+        size = len(columns['cord_uid'])
+        for name in STRING_COLUMNS:
+            lengths = np.zeros(size, dtype=np.int64)
+            valid = np.zeros(size, dtype=bool)
+            for i, value in enumerate(columns[name]):
+                if is_null(value):
+                    continue
+                encoded = str(value).encode('utf-8')
+                self.data[name].write(encoded)
+                lengths[i] = len(encoded)
+                valid[i] = True
+            self.lengths[name].append(lengths)
+            self.valid[name].append(valid)
+        for name in CATEGORY_COLUMNS:
+            categories = self.categories[name]
+            codes = np.full(size, -1, dtype=np.int16)
+            for i, value in enumerate(columns[name]):
+                if is_null(value):
+                    continue
+                codes[i] = categories.setdefault(value, len(categories))
+            self.codes[name].append(codes)
+        for name in DATE_COLUMNS:
+            self.dates[name].append(np.fromiter(
+                (parse_date(value) for value in columns[name]),
+                dtype=np.int32, count=size))
+        self.size += size
+
+    def append_rows(self, rows):
+        """
+        Append legacy corpus.pkl rows.
+        """
+        rows = list(rows)
+        self.append({
+            name: [row[i] for row in rows] for i, name in enumerate(FIELDS)
+        })
+
+    @staticmethod
+    def _concat(arrays, dtype):
+        return np.concatenate(arrays) if arrays else np.empty(0, dtype=dtype)
+
+    def close(self):
+        for name in STRING_COLUMNS:
+            self.data[name].close()
+            offsets = np.zeros(self.size + 1, dtype=np.int64)
+            np.cumsum(self._concat(self.lengths[name], np.int64),
+                      out=offsets[1:])
+            np.save(self._file(name, 'offsets.npy'), offsets)
+            np.save(self._file(name, 'valid.npy'),
+                    self._concat(self.valid[name], bool))
+        for name in CATEGORY_COLUMNS:
+            np.save(self._file(name, 'codes.npy'),
+                    self._concat(self.codes[name], np.int16))
+        for name in DATE_COLUMNS:
+            np.save(self._file(name, 'npy'),
+                    self._concat(self.dates[name], np.int32))
+        with open(os.path.join(self.tmp_path, 'meta.json'), 'w') as f:
+            json.dump({
+                'version': VERSION,
+                'size': self.size,
+                'categories': {
+                    name: list(categories)
+                    for name, categories in self.categories.items()
+                },
+            }, f)
+        replace_dir(self.tmp_path, self.path)
+        return self.path
+
+
+    def abort(self):
+        for name in STRING_COLUMNS:
+            self.data[name].close()
+        rmtree(self.tmp_path)
+
+
+def replace_dir(src, dst):
+    """
+    Move a freshly written store directory in place of the old one. Readers
+    that already mapped files of the old store keep them until they close.
+    """
+    old_path = dst + '.old'
+    if os.path.exists(old_path):
+        rmtree(old_path)
+    if os.path.exists(dst):
+        os.rename(dst, old_path)
+    os.rename(src, dst)
+    if os.path.exists(old_path):
+        rmtree(old_path)
+
+
+def write(path, rows):
+    writer = CorpusWriter(path)
+    writer.append_rows(rows)
+    return writer.close()
+
+
+class ColumnarCorpus(object):
+    """
+    Read side of the columnar store. Every column is memory-mapped, rows are
+    only turned into Python objects when they are accessed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] not in (1, VERSION):
+            raise ValueError(f'Unsupported corpus version {meta["version"]}.')
+        self.size = meta['size']
+        self.categories = meta['categories']
+        self.data = {}
+        self.offsets = {}
+        self.valid = {}
+        self.codes = {}
+        self.dates = {}
+        for name in STRING_COLUMNS:
+            if meta['version'] == 1 and name == 'date':
+                # no date strings yet, dates are formatted back from DATE_COLUMNS
+                continue
+            data_path = self._file(name, 'bin')
+            if os.path.getsize(data_path):
+                self.data[name] = np.memmap(data_path, dtype=np.uint8, mode='r')
+            else:
+                self.data[name] = np.empty(0, dtype=np.uint8)
+            self.offsets[name] = self._load(name, 'offsets.npy')
+            self.valid[name] = self._load(name, 'valid.npy')
+        for name in CATEGORY_COLUMNS:
+            self.codes[name] = self._load(name, 'codes.npy')
+        for name in DATE_COLUMNS:
+            self.dates[name] = self._load(name, 'npy')
+
+    def _file(self, name, ext):
+        return os.path.join(self.path, f'{name}.{ext}')
+
+    def _load(self, name, ext):
+        return np.load(self._file(name, ext), mmap_mode='r')
+
+    def __len__(self):
+        return self.size
+
+    def get(self, name, idx):
+        if name in self.data:
+            if not self.valid[name][idx]:
+                return None
+            start, end = self.offsets[name][idx], self.offsets[name][idx + 1]
+            return self.data[name][start:end].tobytes().decode('utf-8')
+        if name in self.codes:
+            code = self.codes[name][idx]
+            return None if code < 0 else self.categories[name][code]
+        return format_date(int(self.dates[name][idx]))
+
+    def row(self, idx):
+        return {name: self.get(name, idx) for name in FIELDS}
+
+    def __getitem__(self, idx):
+        # legacy corpus.pkl row layout
+        return [self.get(name, idx) for name in FIELDS]
+
+    def column(self, name):
+        for idx in range(self.size):
+            yield self.get(name, idx)
+
+    def valid_uids(self, uid_len=8):
+        lengths = np.diff(self.offsets['cord_uid'])
+        return np.asarray(self.valid['cord_uid']) & (lengths == uid_len)
+
+
+def store_path(legacy_path):
+    """
+    data/corpus.pkl -> data/corpus
+    """
+    return os.path.splitext(legacy_path)[0]
+
+
+def exists(path):
+    return os.path.exists(path) or os.path.exists(store_path(path))
+
+
+class FilterIndex(object):
+    """
+    Precomputed per-field indexes over a corpus: a year array and one packed
+    bitmap per lang/theme/sub_theme category. Filters are turned into a
+    boolean row mask before scoring.
+
+    filters: {'lang': ['en', 'de'], 'theme': [...], 'sub_theme': [...],
+              'year_min': 2019, 'year_max': 2020}
+    """
+
+    def __init__(self, corpus):
+        self.size = len(corpus)
+        self.years = (np.asarray(corpus.dates['date']) // 10000).astype(np.int16)
+        self.bitmaps = {}
+        for name in CATEGORY_COLUMNS:
+            codes = np.asarray(corpus.codes[name])
+            self.bitmaps[name] = {
+                category: np.packbits(codes == code)
+                for code, category in enumerate(corpus.categories[name])
+            }
+
+    def bitmap(self, name, values):
+        bitmaps = self.bitmaps[name]
+        packed = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        for value in values:
+            if value in bitmaps:
+                packed |= bitmaps[value]
+        return packed
+
+    def mask(self, filters, base=None):
+        packed = None
+        for name in CATEGORY_COLUMNS:
+            if filters.get(name):
+                bitmap = self.bitmap(name, filters[name])
+                packed = bitmap if packed is None else packed & bitmap
+        if packed is None:
+            mask = np.ones(self.size, dtype=bool)
+        else:
+            mask = np.unpackbits(packed, count=self.size).astype(bool)
+        if filters.get('year_min') is not None:
+            mask &= self.years >= filters['year_min']
+        if filters.get('year_max') is not None:
+            # null dates have year 0
+            mask &= (self.years <= filters['year_max']) & (self.years > 0)
+        if base is not None:
+            mask &= base
+        return mask
+
+
+def load(path=CORPUS_PATH):
+    """
+    Open a columnar store. Given the legacy corpus.pkl, open the store next
+    to it, converting the pickle on first use.
+    """
+    if os.path.isdir(path):
+        return ColumnarCorpus(path)
+    if not os.path.exists(store_path(path)):
+        convert(path)
+    return ColumnarCorpus(store_path(path))
+
+
+def convert(legacy_path=CORPUS_PATH, path=None):
+    with open(legacy_path, 'rb') as f:
+        rows = pickle.load(f)
+    return write(path or store_path(legacy_path), rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert corpus.pkl into the columnar corpus store.')
+    parser.add_argument('--input', default=CORPUS_PATH, type=str)
+    parser.add_argument('--output', default=None, type=str)
+    args = parser.parse_args()
+
+    print(f'Convert corpus from "{args.input}"...')
+    path = convert(args.input, args.output)
+    print('Corpus available in', path)
@@ -0,0 +1,202 @@
+import argparse
+import os
+
+import numpy as np
+
+import ann
+import corpus
+import embeddings
+
+DATA_PATH = 'data'
+CORPUS_PATH = os.path.join(DATA_PATH, 'corpus.pkl')
+
+# cosine of two abstracts from which they are versions of one paper
+THRESHOLD = 0.97
+# rows per block: the embeddings are split in blocks of about this size by
+# k-means and pairs are only compared within a block and its neighbours
+BLOCK_SIZE = 1024
+# closest other blocks each block is compared against, catches duplicates
+# that fell on both sides of a block boundary
+NEIGHBOR_BLOCKS = 2
+KMEANS_ITER = 5
+
+
+def index_path(corpus_path):
+    """
+    data/corpus.pkl -> data/corpus-duplicates.npy
+    """
+    return corpus.store_path(corpus_path) + '-duplicates.npy'
+
+
+def pairs(embeds, threshold=THRESHOLD, block_size=BLOCK_SIZE,
+          neighbors=NEIGHBOR_BLOCKS, valid=None, seed=0):
+    """
+    (i, j) row pairs, i < j, with a similarity of at least threshold.
+    Blocked: rows are bucketed under k-means centroids and each bucket is
+    compared with itself and its closest buckets, a few small matrix
+    products per bucket instead of an all pairs N x N product. Rows not
+    in `valid` are left out.
+    """
+    empty = np.empty(0, dtype=np.int64)
+    if len(embeds) < 2:
+        return empty, empty
+    index = ann.IVFIndex.build(embeds, max(1, len(embeds) // block_size),
+                               KMEANS_ITER, seed=seed)
+    neighbors = min(neighbors, index.nlist - 1)
+    # blocks closest to each block, itself first
+    closest = np.argsort(-(index.centroids @ index.centroids.T),
+                         axis=1)[:, :neighbors + 1]
+    left, right = [empty], [empty]
+    for block in range(index.nlist):
+        members = np.sort(index._candidates([block]))
+        others = np.sort(index._candidates(closest[block]))
+        if valid is not None:
+            members, others = members[valid[members]], others[valid[others]]
+        if not len(members):
+            continue
+        scores = np.asarray(embeds[members], dtype=np.float32) \
+            @ np.asarray(embeds[others], dtype=np.float32).T
+        i, j = np.nonzero(scores >= threshold)
+        i, j = members[i], others[j]
+        keep = i < j
+        left.append(i[keep])
+        right.append(j[keep])
+    # a pair of neighbouring blocks is seen from both sides
+    pair_ids = np.unique(np.concatenate(left) * len(embeds)
+                         + np.concatenate(right))
+    return pair_ids // len(embeds), pair_ids % len(embeds)
+
+
+def components(size, left, right):
+    """
+    Connected components of the pairs graph, labelled by their smallest
+    row: labels are pulled down along the edges and through each other
+    until nothing changes.
+    """
+    labels = np.arange(size)
+    while True:
+        updated = labels.copy()
+        np.minimum.at(updated, left, labels[right])
+        np.minimum.at(updated, right, labels[left])
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+def canonical_rows(labels, dates):
+    """
+    Row standing for the cluster of each row: the latest version (usually
+    the published one after its preprints), the first row on a tie.
+    """
+    order = np.lexsort((np.arange(len(labels)), -dates, labels))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = labels[order][1:] != labels[order][:-1]
+    sizes = np.diff(np.append(np.flatnonzero(first), len(order)))
+    canonical = np.empty(len(labels), dtype=np.int64)
+    canonical[order] = np.repeat(order[first], sizes)
+    return canonical
+
+
+class Duplicates(object):
+    """
+    Clusters of near-duplicate papers: canonical[i] is the row standing for
+    the cluster of row i, itself when it has no other version.
+    """
+
+    def __init__(self, canonical):
+        self.canonical = canonical
+        self.order = np.argsort(canonical, kind='stable')
+        self.offsets = np.searchsorted(canonical[self.order],
+                                       np.arange(len(canonical) + 1))
+
+    def __len__(self):
+        return len(self.canonical)
+
+    @classmethod
+    def build(cls, store, embeds, threshold=THRESHOLD):
+        valid = store.valid_uids()
+        left, right = pairs(embeds, threshold, valid=valid)
+        labels = components(len(store), left, right)
+        return cls(canonical_rows(labels, np.asarray(store.dates['date'])))
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, self.canonical)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path))
+
+    def collapse(self, hits, mask=None, dates=None):
+        """
+        (idx, score) hits with one row per cluster, at the rank of its best
+        hit: the canonical row if it passes the mask (filters), else the
+        latest version that does (by `dates`, the first row on a tie; the
+        best hit without dates). Hits are expected to pass the mask already.
+        """
+        seen = set()
+        for idx, score in hits:
+            cluster = int(self.canonical[idx])
+            if cluster in seen:
+                continue
+            seen.add(cluster)
+            if mask is None or mask[cluster]:
+                yield cluster, score
+            elif dates is None:
+                yield idx, score
+            else:
+                members = self.order[self.offsets[cluster]:
+                                     self.offsets[cluster + 1]]
+                members = members[mask[members]]
+                yield int(members[np.argmax(dates[members])]), score
+
+    def versions(self, idx):
+        """
+        Rows of the other versions in the cluster of a row.
+        """
+        cluster = self.canonical[idx]
+        members = self.order[self.offsets[cluster]:self.offsets[cluster + 1]]
+        return members[members != idx]
+
+    def nbytes(self):
+        return self.canonical.nbytes + self.order.nbytes + self.offsets.nbytes
+
+    def stats(self):
+        clusters = np.diff(self.offsets)
+        return {
+            'rows': len(self.canonical),
+            'clusters': int((clusters > 1).sum()),
+            'duplicates': int((clusters[clusters > 1] - 1).sum()),
+        }
+
+
+def load(path):
+    return Duplicates.load(path)
+
+
+def build(corpus_path=CORPUS_PATH, embeds_path=None, path=None,
+          threshold=THRESHOLD):
+    path = path or index_path(corpus_path)
+    duplicates = Duplicates.build(corpus.load(corpus_path),
+                                  embeddings.load(embeds_path), threshold)
+    duplicates.save(path)
+    print('Near-duplicates:', duplicates.stats())
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Cluster near-duplicate papers (preprint and published '
+                    'versions) by abstract embedding.')
+    parser.add_argument('--corpus', default=CORPUS_PATH, type=str)
+    parser.add_argument('--model', default='scibert-nli', type=str)
+    parser.add_argument('--threshold', default=THRESHOLD, type=float)
+    args = parser.parse_args()
+
+    embeds_path = os.path.join(DATA_PATH, f'{args.model}-embeddings.pkl')
+    if os.path.exists(embeddings.npy_path(embeds_path)):
+        embeds_path = embeddings.npy_path(embeds_path)
+    print('Clusters available in',
+          build(args.corpus, embeds_path, threshold=args.threshold))
@@ -1,7 +1,7 @@
 import os
 import argparse
 from shutil import rmtree
-from transformers import AutoTokenizer, AutoModel
+from transformers import AutoTokenizer, AutoModel, AutoModelForSequenceClassification
 from sentence_transformers import models, SentenceTransformer
 
 MODELS_PATH = "models"
@@ -18,7 +18,12 @@ MODELS_FINETUNED = {
     'covidbert-nli': 'gsarti/covidbert-nli'
 }
 
-MODELS = {**MODELS_PRETRAINED, **MODELS_FINETUNED}
+# cross-encoders for the re-ranking stage (RERANK_MODEL in papers.py)
+MODELS_RERANKERS = {
+    'ms-marco-minilm': 'cross-encoder/ms-marco-MiniLM-L-6-v2',
+}
+
+MODELS = {**MODELS_PRETRAINED, **MODELS_FINETUNED, **MODELS_RERANKERS}
 
 
 if __name__ == "__main__":
@@ -28,8 +33,7 @@ if __name__ == "__main__":
         default="scibert-nli", 
         type=str, 
         required=False,
-        help="Model selected in the list: " + 
-             ", ".join(list(MODELS_PRETRAINED) + list(MODELS_FINETUNED))
+        help="Model selected in the list: " + ", ".join(MODELS)
     )
     parser.add_argument(
         "--do_lower_case", 
@@ -43,16 +47,25 @@ if __name__ == "__main__":
         required=False,
         help="Sequence length used by the language model."
     )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Also save an int8 query encoder next to the model and "
+             "report how close its embeddings are to the original."
+    )
     args = parser.parse_args()
     path = os.path.join(MODELS_PATH, args.model)
     if not os.path.exists(path):
         os.makedirs(path)
-    if args.model not in list(MODELS_PRETRAINED) + list(MODELS_FINETUNED):
+    if args.model not in MODELS:
         raise AttributeError("Model should be selected in the list: " + 
-            ", ".join(list(MODELS_PRETRAINED) + list(MODELS_FINETUNED))
+            ", ".join(MODELS)
         )
     tokenizer = AutoTokenizer.from_pretrained(MODELS[args.model])
-    model = AutoModel.from_pretrained(MODELS[args.model])
+    if args.model in MODELS_RERANKERS: # keep the relevance head
+        model = AutoModelForSequenceClassification.from_pretrained(MODELS[args.model])
+    else:
+        model = AutoModel.from_pretrained(MODELS[args.model])
     model.save_pretrained(path)
     tokenizer.save_pretrained(path)
     if args.model in MODELS_FINETUNED.keys(): # Build the SentenceTransformer directly
@@ -69,3 +82,10 @@ if __name__ == "__main__":
         rmtree(path)
         model.save(path)
     print(f'Model {args.model} available in', path)
+    # re-rankers are quantized on load instead (RERANK_QUANTIZE)
+    if args.quantize and args.model not in MODELS_RERANKERS:
+        import encoder
+        quantized = encoder.save_quantized(path)
+        encoder.check(SentenceTransformer(path, device='cpu'),
+                      encoder.QueryEncoder(quantized))
+        print(f'Quantized query encoder available in', quantized)
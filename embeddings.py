@@ -0,0 +1,68 @@
+import argparse
+import os
+import pickle
+
+import numpy as np
+
+import search
+
+DATA_PATH = 'data'
+
+DTYPES = ('float32', 'float16')
+
+
+def npy_path(embeds_path):
+    """
+    data/scibert-nli-embeddings.pkl -> data/scibert-nli-embeddings.npy
+    """
+    return os.path.splitext(embeds_path)[0] + '.npy'
+
+
+def save(path, embeds, dtype='float32'):
+    """
+    Store normalized embeddings as a plain .npy matrix. The file is written
+    to a temp path first and moved in place, so processes that still map the
+    previous version keep reading consistent data.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f'dtype should be one of {", ".join(DTYPES)}')
+    embeds = search.normalize(embeds).astype(dtype, copy=False)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, embeds)
+    os.replace(tmp_path, path)
+
+
+def load(path):
+    """
+    Open embeddings for search. A .npy store is memory-mapped read-only, so
+    its pages live in the OS page cache and are shared by every process that
+    opens the same file. A legacy pickle is loaded into the heap and
+    normalized.
+    """
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    with open(path, 'rb') as f:
+        return search.normalize(pickle.load(f))
+
+
+def convert(pkl_path, path=None, dtype='float32'):
+    path = path or npy_path(pkl_path)
+    with open(pkl_path, 'rb') as f:
+        embeds = pickle.load(f)
+    save(path, embeds, dtype)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert pickled embeddings into a memory-mappable store.')
+    parser.add_argument('--model', default='scibert-nli', type=str)
+    parser.add_argument('--dtype', default='float32', choices=DTYPES,
+                        help='Storage precision, float16 halves the size.')
+    args = parser.parse_args()
+
+    pkl_path = os.path.join(DATA_PATH, f'{args.model}-embeddings.pkl')
+    print(f'Convert embeddings from "{pkl_path}"...')
+    path = convert(pkl_path, dtype=args.dtype)
+    print('Embeddings available in', path)
@@ -0,0 +1,134 @@
+import argparse
+import os
+
+import torch
+from sentence_transformers import SentenceTransformer
+
+import search
+
+MODELS_PATH = 'models'
+# file holding a dynamically quantized model, see save_quantized
+QUANTIZED_FILE = 'quantized.pt'
+QUANTIZED_SUFFIX = '-int8'
+# queries are short, padding them to the 128 tokens of the abstracts is waste
+QUERY_MAX_SEQ_LENGTH = 64
+
+CHECK_QUERIES = [
+    'whats corona',
+    'incubation period',
+    'what is the mortality rate of covid-19 in elderly patients',
+    'ace2 receptor binding of the spike protein',
+    'hydroxychloroquine treatment outcomes',
+    'asymptomatic transmission in households',
+    'face masks effectiveness',
+    'vaccine candidates in clinical trials',
+]
+
+
+def quantized_path(model_path):
+    """
+    models/scibert-nli -> models/scibert-nli-int8
+    """
+    return model_path.rstrip(os.sep) + QUANTIZED_SUFFIX
+
+
+def quantize_dynamic(model):
+    """
+    int8 weights for every linear layer, activations quantized on the fly.
+    """
+    return torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def load_quantized(path):
+    path = os.path.join(path, QUANTIZED_FILE)
+    try:
+        # a whole pickled module, not only weights (torch >= 2.6 default)
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:
+        return torch.load(path, map_location='cpu')
+
+
+def save_quantized(model_path, path=None):
+    path = path or quantized_path(model_path)
+    model = quantize_dynamic(SentenceTransformer(model_path, device='cpu'))
+    os.makedirs(path, exist_ok=True)
+    torch.save(model, os.path.join(path, QUANTIZED_FILE))
+    return path
+
+
+def nbytes(model):
+    """
+    Size of the weights of a torch module, int8 packed ones included.
+    """
+    total = 0
+    for value in model.state_dict().values():
+        values = value if isinstance(value, tuple) else (value,)
+        for tensor in values:
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class QueryEncoder(object):
+    """
+    SentenceTransformer set up for low latency query encoding on CPU: no
+    autograd bookkeeping, a fixed torch thread count, a short max sequence
+    length and optionally int8 linear layers.
+    """
+
+    def __init__(self, model_path, quantize=False, threads=None,
+                 max_seq_length=QUERY_MAX_SEQ_LENGTH):
+        if threads:
+            torch.set_num_threads(threads)
+        if os.path.exists(os.path.join(model_path, QUANTIZED_FILE)):
+            # saved by save_quantized, already int8
+            self.model = load_quantized(model_path)
+        else:
+            self.model = SentenceTransformer(model_path, device='cpu')
+            if quantize:
+                self.model = quantize_dynamic(self.model)
+        self.model.eval()
+        if max_seq_length:
+            self.model._first_module().max_seq_length = max_seq_length
+
+    def nbytes(self):
+        return nbytes(self.model)
+
+    def encode(self, queries, show_progress_bar=False, **kwargs):
+        # inference_mode also skips the version counters no_grad keeps
+        no_grad = getattr(torch, 'inference_mode', torch.no_grad)
+        with no_grad():
+            return self.model.encode(queries,
+                                     show_progress_bar=show_progress_bar,
+                                     **kwargs)
+
+
+def check(reference, candidate, queries=CHECK_QUERIES):
+    """
+    Cosine similarity between reference (fp32) and candidate embeddings of
+    the same queries, 1.0 means identical directions.
+    """
+    expected = search.normalize(reference.encode(queries, show_progress_bar=False))
+    actual = search.normalize(candidate.encode(queries, show_progress_bar=False))
+    similarity = (expected * actual).sum(axis=1)
+    print(f'Cosine to fp32 over {len(queries)} queries: '
+          f'mean {similarity.mean():.4f}, min {similarity.min():.4f}')
+    return similarity
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare the fast query encoder against the fp32 model.')
+    parser.add_argument('--model', default='scibert-nli', type=str)
+    parser.add_argument('--quantize', action='store_true',
+                        help='Quantize the linear layers to int8 on load.')
+    parser.add_argument('--threads', default=None, type=int)
+    parser.add_argument('--max_seq_length', default=QUERY_MAX_SEQ_LENGTH, type=int)
+    args = parser.parse_args()
+
+    model_path = os.path.join(MODELS_PATH, args.model)
+    reference = SentenceTransformer(model_path, device='cpu')
+    candidate = QueryEncoder(model_path, args.quantize, args.threads,
+                             args.max_seq_length)
+    check(reference, candidate)
@@ -0,0 +1,251 @@
+import argparse
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+from sentence_transformers import SentenceTransformer
+
+import ann
+import corpus
+import dedup
+import embeddings
+import lexical
+import passages
+import quantize
+import search
+
+DATA_PATH = 'data'
+MODELS_PATH = 'models'
+METADATA_PATH = os.path.join(DATA_PATH, 'metadata_codevscovid.csv')
+CORPUS_PATH = os.path.join(DATA_PATH, 'corpus.pkl')
+
+# metadata csv column -> corpus field
+UID_LEN = 8
+# metadata rows read at once
+CHUNK_SIZE = 10000
+
+CSV_COLUMNS = {
+    'abstract': 'abstract',
+    'publish_time': 'date',
+    'language': 'lang',
+    'title': 'title',
+    'url': 'url',
+    'main_topic': 'theme',
+    'main_subtopic': 'sub_theme',
+    'cord_uid': 'cord_uid',
+}
+
+
+def iter_metadata(metadata_path=METADATA_PATH, chunk_size=CHUNK_SIZE):
+    """
+    Stream the metadata csv as corpus column chunks {field: list}, reading
+    only the needed columns as strings. Rows without a valid cord_uid or
+    without a usable abstract are dropped chunk by chunk, so memory stays
+    bounded by the chunk size whatever the file size.
+    """
+    chunks = pd.read_csv(metadata_path,
+                         usecols=list(CSV_COLUMNS),
+                         dtype={name: str for name in CSV_COLUMNS},
+                         chunksize=chunk_size)
+    for df in chunks:
+        df = df.rename(columns=CSV_COLUMNS)
+        abstract = df['abstract'].fillna('').str.strip()
+        keep = (abstract != '') & (abstract != 'Unknown')
+        keep &= df['cord_uid'].fillna('').str.len() == UID_LEN
+        df = df[keep]
+        if len(df):
+            yield {name: df[name].tolist() for name in corpus.FIELDS}
+
+
+def write_corpus(metadata_path=METADATA_PATH, corpus_path=CORPUS_PATH,
+                 chunk_size=CHUNK_SIZE):
+    """
+    Build the columnar corpus store straight from the metadata csv.
+    """
+    writer = corpus.CorpusWriter(corpus.store_path(corpus_path))
+    for columns in iter_metadata(metadata_path, chunk_size):
+        writer.append(columns)
+    print('Corpus size', writer.size)
+    return writer.close()
+
+
+def abstract_hash(abstract):
+    return hashlib.sha1(abstract.encode('utf-8')).digest()
+
+
+def old_rows(old_corpus):
+    """
+    (cord_uid, abstract hash) -> row index in the current corpus.
+    """
+    rows = {}
+    if old_corpus is not None:
+        for idx in range(len(old_corpus)):
+            abstract = old_corpus.get('abstract', idx) or ''
+            key = (old_corpus.get('cord_uid', idx), abstract_hash(abstract))
+            rows.setdefault(key, idx)
+    return rows
+
+
+def diff(rows, columns):
+    """
+    Index of the old corpus row holding the same cord_uid and abstract for
+    every new row, -1 if the row is new or its abstract changed.
+    """
+    return np.array([
+        rows.get((uid, abstract_hash(abstract)), -1)
+        for uid, abstract in zip(columns['cord_uid'], columns['abstract'])
+    ], dtype=np.int64)
+
+
+def same_titles(old_corpus, reuse, titles):
+    """
+    reuse (see diff) with -1 where the title changed too: passages hold the
+    title, the abstract embedding doesn't.
+    """
+    reuse = reuse.copy()
+    for i in np.flatnonzero(reuse >= 0):
+        title = None if corpus.is_null(titles[i]) else str(titles[i])
+        if old_corpus.get('title', reuse[i]) != title:
+            reuse[i] = -1
+    return reuse
+
+
+def ingest(metadata_path, model_path, corpus_path, embeds_path,
+           index_path=None, dtype='float32', full=False, passage_search=False):
+    """
+    Bring the corpus, embedding, BM25, duplicates and index stores up to
+    date with a new metadata release. Only rows whose cord_uid is new or
+    whose abstract changed go through the model, all other embeddings are
+    copied over. Every store is written next to the old one and moved in
+    place, so a running server keeps answering from the previous version
+    until it reloads (SIGHUP or POST /reload, see papers.py). After a model change pass
+    full=True, which also retrains the index. The passage store is kept up to date the same way once it
+    exists, or built with passage_search=True.
+    """
+    old_corpus = None
+    if not full and corpus.exists(corpus_path):
+        old_corpus = corpus.load(corpus_path)
+    old_embeds = None
+    npy_path = embeddings.npy_path(embeds_path)
+    for path in (npy_path, embeds_path):
+        if old_corpus is not None and os.path.exists(path):
+            old_embeds = embeddings.load(path)
+            break
+    if old_embeds is not None and len(old_embeds) != len(old_corpus):
+        print('Corpus and embeddings don\'t match, encoding everything.')
+        old_corpus, old_embeds = None, None
+    if old_embeds is None:
+        old_corpus = None
+    old_passages = None
+    if old_corpus is not None and passages.exists(embeds_path):
+        old_passages = passages.PassageStore.load(embeds_path)
+        if len(old_passages) != len(old_corpus):
+            print('Corpus and passages don\'t match, encoding all passages.')
+            old_passages = None
+
+    # one streaming pass: write the new corpus and collect what to encode
+    rows = old_rows(old_corpus)
+    known = {uid for uid, _ in rows}
+    reuse = []
+    passage_reuse = []
+    texts = []
+    added = 0
+    writer = corpus.CorpusWriter(corpus.store_path(corpus_path))
+    for columns in iter_metadata(metadata_path):
+        chunk_reuse = diff(rows, columns)
+        for i in np.flatnonzero(chunk_reuse < 0):
+            texts.append(columns['abstract'][i])
+            added += columns['cord_uid'][i] not in known
+        reuse.append(chunk_reuse)
+        if old_passages is not None:
+            passage_reuse.append(
+                same_titles(old_corpus, chunk_reuse, columns['title']))
+        writer.append(columns)
+    reuse = np.concatenate(reuse) if reuse else np.empty(0, dtype=np.int64)
+    passage_reuse = np.concatenate(passage_reuse) if passage_reuse else None
+    size = len(reuse)
+    reused = reuse >= 0
+    encode = np.flatnonzero(~reused)
+    print(f'{size} rows: {reused.sum()} unchanged, {added} new, '
+          f'{len(encode) - added} changed')
+
+    if len(encode):
+        print(f'Encoding {len(encode)} abstracts...')
+        model = SentenceTransformer(model_path)
+        encoded = search.normalize(model.encode(texts, show_progress_bar=True))
+        if reused.any() and encoded.shape[1] != old_embeds.shape[1]:
+            writer.abort()
+            raise ValueError('The model changed, run a full ingest.')
+        new_embeds = np.empty((size, encoded.shape[1]), dtype=np.float32)
+        new_embeds[encode] = encoded
+    elif old_embeds is not None:
+        new_embeds = np.empty((size, old_embeds.shape[1]), dtype=np.float32)
+    else:
+        writer.abort()
+        raise ValueError('Nothing to ingest.')
+    if reused.any():
+        new_embeds[reused] = old_embeds[reuse[reused]]
+
+    # corpus first, a server that reloads in between refuses the mismatch
+    writer.close()
+    embeddings.save(npy_path, new_embeds, dtype)
+    print('Build BM25 index...')
+    lexical.build(corpus_path)
+    print('Cluster near-duplicates...')
+    dedup.build(corpus_path, npy_path)
+    if passage_search or passages.exists(embeds_path):
+        print('Update passages...')
+        passages.build(corpus.load(corpus_path), model_path, old_passages,
+                       passage_reuse).save(embeds_path)
+
+    if index_path is not None and os.path.exists(index_path):
+        centroids = np.load(index_path)['centroids']
+        if full:
+            # same dims don't mean the same space: after a model change the
+            # old centroids would bucket the rows arbitrarily
+            print('Retrain index...')
+            ann.IVFIndex.build(embeddings.load(npy_path), len(centroids)) \
+                .save(index_path)
+        elif centroids.shape[1] == new_embeds.shape[1]:
+            print('Update index with the existing centroids...')
+            ann.IVFIndex.from_centroids(embeddings.load(npy_path), centroids) \
+                .save(index_path)
+        else:
+            # trained for another model, fall back to exact search
+            print('Index doesn\'t match the embeddings, removing it.')
+            os.remove(index_path)
+
+    for mode in quantize.MODES:
+        path = quantize.codes_path(npy_path, mode)
+        if os.path.exists(path):
+            print(f'Update {mode} codes...')
+            quantize.save(path, quantize.train(embeddings.load(npy_path), mode))
+    return size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Incrementally update corpus, embeddings and index from '
+                    'a new metadata release.')
+    parser.add_argument('--metadata', default=METADATA_PATH, type=str)
+    parser.add_argument('--model', default='scibert-nli', type=str)
+    parser.add_argument('--dtype', default='float32', choices=embeddings.DTYPES)
+    parser.add_argument('--full', action='store_true',
+                        help='Re-encode every abstract, e.g. after a model change.')
+    parser.add_argument('--passages', action='store_true',
+                        help='Also split titles and abstracts into passages '
+                             'and encode them (kept up to date once built).')
+    args = parser.parse_args()
+
+    embeds_path = os.path.join(DATA_PATH, f'{args.model}-embeddings.pkl')
+    ingest(args.metadata,
+           os.path.join(MODELS_PATH, args.model),
+           CORPUS_PATH,
+           embeds_path,
+           ann.index_path(embeds_path),
+           args.dtype,
+           args.full,
+           args.passages)
+    print('Ingest done, send SIGHUP to `python papers.py` (or POST /reload '
+          'to a server importing the app) to switch to the new data.')
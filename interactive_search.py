@@ -1,16 +1,19 @@
 import numpy as np
-from sentence_transformers import SentenceTransformer
-import scipy
-import pandas as pd
 import os
 import textwrap
 import json
 import prettytable
 import logging
-import pickle
 import warnings
 warnings.simplefilter('ignore')
 
+import build_embeddings
+import corpus as corpus_store
+import embeddings as embeddings_store
+import encoder
+import ingest
+import search
+
 METADATA_PATH = 'data/metadata_codevscovid.csv'
 
 DATA_PATH = 'data'
@@ -19,7 +22,7 @@ MODEL_NAME = 'scibert-nli'
 CORPUS_PATH = os.path.join(DATA_PATH, 'corpus.pkl')
 MODEL_PATH = os.path.join(MODELS_PATH, MODEL_NAME)
 EMBEDDINGS_PATH = os.path.join(DATA_PATH, f'{MODEL_NAME}-embeddings.pkl')
-# EMBEDDINGS_NP_PATH = os.path.join(DATA_PATH, f'{MODEL_NAME}-embeddings.npy')
+EMBEDDINGS_NP_PATH = os.path.join(DATA_PATH, f'{MODEL_NAME}-embeddings.npy')
 
 
 # corpus dimesions :
@@ -27,77 +30,49 @@ EMBEDDINGS_PATH = os.path.join(DATA_PATH, f'{MODEL_NAME}-embeddings.pkl')
 # 1: date
 # 2: language
 def cache_corpus(mode='CSV'):
-    corpus = []
     if mode == 'CSV':
-        df = pd.read_csv(METADATA_PATH)
-        test = df[['abstract',
-                   'publish_time',
-                   'language',
-                   'title',
-                   'url',
-                   'main_topic',
-                   'main_subtopic',
-                   'cord_uid']]
-        for a, b, c, d, e, f, g, h in test.itertuples(index=False):
-            if type(a) == str and a != "Unknown":
-                corpus.append([a, b, c, d, e, f, g, h])
-        print('Corpus size', len(corpus))
+        # streamed chunk by chunk into the columnar store
+        ingest.write_corpus(METADATA_PATH, CORPUS_PATH)
     elif mode == 'JSON':
         raise NotImplementedError('Feature removed')
     else:
         raise AttributeError('Mode should be either CSV or JSON')
-    with open(CORPUS_PATH, 'wb') as file:
-        pickle.dump(corpus, file)
-    return corpus
+    return corpus_store.load(CORPUS_PATH)
 
-# return true if search filters are satisified
+# convert [date_min, date_max, lang] search filters into a row mask
 
 
-def check_constraints(filters, date, lang):
-    valid = True
+def filter_mask(filters, filter_index):
     [date_filter_min, date_filter_max, language_filter] = filters
-    date = int(date[:4])
-    if date_filter_min is not None:
-        if date < date_filter_min:
-            valid = False
-    if date_filter_max is not None:
-        if date > date_filter_max:
-            valid = False
-    if language_filter is not None:
-        if lang != language_filter:
-            valid = False
-
-    return valid
+    return filter_index.mask({
+        'year_min': date_filter_min,
+        'year_max': date_filter_max,
+        'lang': [language_filter] if language_filter is not None else None,
+    })
 
 
-def ask_question(query, model, corpus, corpus_embed, filters, top_k=5):
+def ask_question(query, model, corpus, corpus_embed, filters, top_k=5,
+                 filter_index=None):
     """
     Adapted from https://www.kaggle.com/dattaraj/risks-of-covid-19-ai-driven-q-a
+
+    corpus_embed is expected to be normalized with search.normalize.
     """
+    if filter_index is None:
+        filter_index = corpus_store.FilterIndex(corpus)
+    mask = filter_mask(filters, filter_index)
     queries = [query]
-    query_embeds = model.encode(queries, show_progress_bar=False)
+    query_embeds = search.normalize(
+        model.encode(queries, show_progress_bar=False))
     for query, query_embed in zip(queries, query_embeds):
-        distances = scipy.spatial.distance.cdist(
-            [query_embed], corpus_embed, "cosine")[0]
-        distances = zip(range(len(distances)), distances)
-        distances = sorted(distances, key=lambda x: x[1])
         results = []
-        j = 0
-        for count, (idx, distance) in enumerate(distances):
-            # TODO check the filters
-            date = corpus[idx][1]
-            lang = corpus[idx][2]
-            title = corpus[idx][3]
-            url = corpus[idx][4]
-            theme = corpus[idx][5]
-            sub_theme = corpus[idx][6]
-            cord_uid = corpus[idx][7]
-
-            if check_constraints(filters, date, lang):
-                j += 1
-                results.append([count + 1, corpus[idx][0].strip(), round(1 - distance, 4),
-                                date, lang, title, url, theme, sub_theme, cord_uid])
-            if j >= top_k:
+        hits = search.iter_search(corpus_embed, query_embed, top_k, mask)
+        for count, (idx, score) in enumerate(hits):
+            [abstract, date, lang, title, url, theme, sub_theme,
+             cord_uid] = corpus[idx]
+            results.append([count + 1, abstract.strip(), round(score, 4),
+                            date, lang, title, url, theme, sub_theme, cord_uid])
+            if len(results) >= top_k:
                 break
     return results
 
@@ -192,28 +167,26 @@ def verify_language(language):
 
 if __name__ == '__main__':
     os.system('cls' if os.name == 'nt' else 'clear')
-    if not os.path.exists(CORPUS_PATH):
+    if not corpus_store.exists(CORPUS_PATH):
         print("Caching the corpus for future use...")
         corpus = cache_corpus()
     else:
         print("Loading the corpus from", CORPUS_PATH, '...')
-        with open(CORPUS_PATH, 'rb') as corpus_pt:
-            corpus = pickle.load(corpus_pt)
+        corpus = corpus_store.load(CORPUS_PATH)
 
-    corpus_abstract = []
-    model = SentenceTransformer(MODEL_PATH)
-    for i in range(len(corpus)):
-        corpus_abstract.append(corpus[i][0])
+    model = encoder.QueryEncoder(MODEL_PATH)
 
-    if not os.path.exists(EMBEDDINGS_PATH):
-        print("Computing and caching model embeddings for future use...")
-        embeddings = model.encode(corpus_abstract, show_progress_bar=True)
-        with open(EMBEDDINGS_PATH, 'wb') as file:
-            pickle.dump(embeddings, file)
-    else:
+    if os.path.exists(EMBEDDINGS_NP_PATH):
+        print("Loading model embeddings from", EMBEDDINGS_NP_PATH, '...')
+        embeddings = embeddings_store.load(EMBEDDINGS_NP_PATH)
+    elif os.path.exists(EMBEDDINGS_PATH):
         print("Loading model embeddings from", EMBEDDINGS_PATH, '...')
-        with open(EMBEDDINGS_PATH, 'rb') as file:
-            embeddings = pickle.load(file)
+        embeddings = embeddings_store.load(EMBEDDINGS_PATH)
+    else:
+        print("Computing and caching model embeddings for future use...")
+        build_embeddings.build(CORPUS_PATH, MODEL_PATH, EMBEDDINGS_NP_PATH)
+        embeddings = embeddings_store.load(EMBEDDINGS_NP_PATH)
+    filter_index = corpus_store.FilterIndex(corpus)
 
     while True:
         verified = False
@@ -236,7 +209,8 @@ if __name__ == '__main__':
             verified, language_filter = verify_language(language_filter)
 
         filters = [date_filter_min, date_filter_max, language_filter]
-        results = ask_question(query, model, corpus, embeddings, filters)
+        results = ask_question(query, model, corpus, embeddings, filters,
+                               filter_index=filter_index)
 
         # save_answers(results)
         show_answers(results)
@@ -0,0 +1,210 @@
+import argparse
+import os
+import re
+from array import array
+from collections import Counter
+
+import numpy as np
+
+import corpus
+import search
+
+DATA_PATH = 'data'
+CORPUS_PATH = os.path.join(DATA_PATH, 'corpus.pkl')
+
+# BM25 term frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+# term frequencies are stored in a byte, BM25 saturates long before that
+TF_MAX = 255
+# words kept together with inner dashes and dots: sars-cov-2, il-6, 2019-ncov
+TOKEN_RE = re.compile(r'[a-z0-9]+(?:[-.][a-z0-9]+)*')
+STOPWORDS = frozenset('''
+a an and are as at be by for from has have in is it its of on or that the
+their these this to was were which with we our not also been but than
+'''.split())
+
+
+def index_path(corpus_path):
+    """
+    data/corpus.pkl -> data/corpus-bm25.npz
+    """
+    return corpus.store_path(corpus_path) + '-bm25.npz'
+
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall(text.lower())
+            if token not in STOPWORDS]
+
+
+def varint_encode(values):
+    """
+    7 bits per byte, high bit set on every byte but the last of a value.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for bits in range(7, 64, 7):
+        nbytes += values >= np.uint64(1 << bits)
+    ids = np.repeat(np.arange(len(values)), nbytes)
+    starts = np.cumsum(nbytes) - nbytes
+    shifts = (np.arange(len(ids)) - starts[ids]) * 7
+    out = (values[ids] >> shifts.astype(np.uint64)) & np.uint64(0x7f)
+    out[shifts < (nbytes[ids] - 1) * 7] |= np.uint64(0x80)
+    return out.astype(np.uint8), nbytes
+
+
+def varint_decode(data):
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    ids = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = ((np.arange(len(data)) - starts[ids]) * 7).astype(np.uint64)
+    parts = (data & 0x7f).astype(np.uint64) << shifts
+    return np.add.reduceat(parts, starts).astype(np.int64)
+
+
+class BM25Index(object):
+    """
+    Inverted index over title + abstract. The postings of a term are its
+    row ids, delta and varint encoded, next to one byte term frequencies.
+    Terms are looked up in a dict built from the newline separated
+    vocabulary on load.
+    """
+
+    def __init__(self, terms, offsets, df, postings, tfs, lengths):
+        self.terms = terms
+        self.offsets = offsets
+        self.df = df
+        self.postings = postings
+        self.tfs = tfs
+        self.lengths = lengths
+        self.tf_offsets = np.concatenate(([0], np.cumsum(df, dtype=np.int64)))
+        self.vocabulary = {
+            term: i for i, term in
+            enumerate(bytes(terms).decode('utf-8').split('\n'))
+        } if len(terms) else {}
+        self.avg_length = max(float(lengths.mean()), 1) if len(lengths) else 1
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @classmethod
+    def build(cls, store):
+        vocabulary = {}
+        term_ids = array('q')
+        tfs = array('B')
+        counts = np.zeros(len(store), dtype=np.int64)
+        lengths = np.zeros(len(store), dtype=np.int32)
+        for idx in range(len(store)):
+            text = ' '.join(store.get(name, idx) or ''
+                            for name in ('title', 'abstract'))
+            tokens = tokenize(text)
+            lengths[idx] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                tfs.append(min(tf, TF_MAX))
+            counts[idx] = len(term_ids)
+        counts[1:] -= counts[:-1].copy()
+
+        term_ids = np.frombuffer(term_ids, dtype=np.int64) if len(term_ids) \
+            else np.empty(0, dtype=np.int64)
+        # stable: rows stay ascending within every term
+        order = np.argsort(term_ids, kind='stable')
+        rows = np.repeat(np.arange(len(store)), counts)[order]
+        df = np.bincount(term_ids, minlength=len(vocabulary)).astype(np.int32)
+        firsts = np.cumsum(df, dtype=np.int64) - df
+        deltas = rows.copy()
+        deltas[1:] -= rows[:-1]
+        deltas[firsts] = rows[firsts]
+        postings, nbytes = varint_encode(deltas)
+        byte_offsets = np.concatenate(([0], np.cumsum(nbytes)))
+        offsets = byte_offsets[np.append(firsts, len(rows))]
+
+        terms = sorted(vocabulary, key=vocabulary.get)
+        return cls(np.frombuffer('\n'.join(terms).encode('utf-8'), dtype=np.uint8),
+                   offsets,
+                   df,
+                   postings,
+                   np.frombuffer(tfs, dtype=np.uint8)[order],
+                   lengths)
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, terms=self.terms, offsets=self.offsets, df=self.df,
+                 postings=self.postings, tfs=self.tfs, lengths=self.lengths)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['terms'], data['offsets'], data['df'],
+                   data['postings'], data['tfs'], data['lengths'])
+
+    def posting(self, term):
+        """
+        (rows, term frequencies) of a term, empty if unknown.
+        """
+        i = self.vocabulary.get(term)
+        if i is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8)
+        rows = np.cumsum(varint_decode(
+            self.postings[self.offsets[i]:self.offsets[i + 1]]))
+        return rows, self.tfs[self.tf_offsets[i]:self.tf_offsets[i + 1]]
+
+    def scores(self, query, mask=None):
+        """
+        BM25 of every row matching at least one query term, as (rows, scores)
+        with rows ascending.
+        """
+        rows, scores = [], []
+        for term, qtf in Counter(tokenize(query)).items():
+            term_rows, tfs = self.posting(term)
+            if mask is not None:
+                keep = mask[term_rows]
+                term_rows, tfs = term_rows[keep], tfs[keep]
+            if not len(term_rows):
+                continue
+            df = self.df[self.vocabulary[term]]
+            idf = np.log(1 + (len(self) - df + 0.5) / (df + 0.5))
+            tfs = tfs.astype(np.float32)
+            norm = K1 * (1 - B + B * self.lengths[term_rows] / self.avg_length)
+            rows.append(term_rows)
+            scores.append(qtf * idf * tfs * (K1 + 1) / (tfs + norm))
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        rows, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(scores))
+        return rows, scores.astype(np.float32)
+
+    def iter_search(self, query, k, mask=None):
+        """
+        (idx, score) best first, scores relative to the best match so they
+        fall in (0, 1] like the cosine similarities.
+        """
+        rows, scores = self.scores(query, mask)
+        if not len(rows):
+            return
+        scores /= scores.max()
+        for i in search.iter_top_k(scores, k):
+            yield int(rows[i]), float(scores[i])
+
+
+def load(path):
+    return BM25Index.load(path)
+
+
+def build(corpus_path=CORPUS_PATH, path=None):
+    path = path or index_path(corpus_path)
+    BM25Index.build(corpus.load(corpus_path)).save(path)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the BM25 inverted index over titles and abstracts.')
+    parser.add_argument('--corpus', default=CORPUS_PATH, type=str)
+    args = parser.parse_args()
+
+    print('BM25 index available in', build(args.corpus))
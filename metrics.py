@@ -0,0 +1,285 @@
+import contextvars
+import resource
+import sys
+import threading
+import time
+from collections import Counter as Tally
+from contextlib import contextmanager
+
+# seconds, from sub-millisecond cache hits to slow model calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+PROFILE_INTERVAL = 0.005
+# distinct stacks kept by the profiler, the rarest are dropped beyond that
+PROFILE_MAX_STACKS = 10000
+
+# (stage, seconds) list of the request being handled, None outside requests
+_timings = contextvars.ContextVar('timings', default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.kind}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f'{self.name}{_labels(self.labels, key)} {_number(value)}'
+                for key, value in values]
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self.values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _labels(self.labels + ('le',), key + (_number(bound),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _labels(self.labels, key)
+            lines.append(f'{self.name}_sum{labels} {_number(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Callback(Metric):
+    """
+    Values read at scrape time: fn() returns {label values tuple: value}.
+    """
+
+    def __init__(self, name, help, fn, labels=(), kind='gauge'):
+        super().__init__(name, help, labels)
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self):
+        try:
+            values = sorted(self.fn().items())
+        except Exception:
+            return []
+        return [f'{self.name}{_labels(self.labels, key)} {_number(value)}'
+                for key, value in values]
+
+
+REGISTRY = []
+
+
+def render():
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+STAGE_SECONDS = Histogram('papers_stage_seconds',
+                          'Time spent per answer stage.', ('stage',))
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a stage into the stage histogram and the current request timings.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+@contextmanager
+def recording():
+    """
+    Collect the stages timed within into a fresh list, e.g. for a batch
+    answered outside the request thread.
+    """
+    timings = []
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def start_request():
+    return _timings.set([])
+
+
+def end_request(token):
+    timings = _timings.get()
+    _timings.reset(token)
+    return timings or []
+
+
+def add_timings(timings):
+    """
+    Add stages timed elsewhere (e.g. by the micro-batcher) to the request.
+    """
+    current = _timings.get()
+    if current is not None and timings:
+        current.extend(timings)
+
+
+def server_timing(timings, total=None):
+    """
+    Server-Timing header value, repeated stages summed.
+    """
+    durations = {}
+    for name, seconds in timings:
+        durations[name] = durations.get(name, 0) + seconds
+    if total is not None:
+        durations['total'] = total
+    return ', '.join(f'{name};dur={seconds * 1000:.3f}'
+                     for name, seconds in durations.items())
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # peak instead of current where /proc is missing
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+Callback('papers_process_resident_bytes', 'Resident memory of the process.',
+         lambda: {(): rss_bytes()})
+
+
+class Profiler(object):
+    """
+    Sampling profiler: a thread snapshots the stack of every other thread
+    each interval and counts identical stacks. report() returns them in
+    the collapsed format flame graph tools read ("a;b;c count").
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stacks = Tally()
+        self.samples = 0
+        self.thread = None
+        self.running = threading.Event()
+        self.interval = PROFILE_INTERVAL
+
+    @property
+    def enabled(self):
+        return self.running.is_set()
+
+    def start(self, interval=PROFILE_INTERVAL):
+        with self.lock:
+            if self.running.is_set():
+                return
+            self.stacks.clear()
+            self.samples = 0
+            self.interval = interval
+            self.running.set()
+            self.thread = threading.Thread(target=self._run, name='profiler',
+                                           daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while self.running.is_set():
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f'{code.co_name} '
+                                     f'({code.co_filename}:{frame.f_lineno})')
+                        frame = frame.f_back
+                    self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+                if len(self.stacks) > PROFILE_MAX_STACKS:
+                    self.stacks = Tally(dict(
+                        self.stacks.most_common(PROFILE_MAX_STACKS // 2)))
+            del frames
+            time.sleep(self.interval)
+
+    def report(self):
+        with self.lock:
+            return ''.join(f'{stack} {count}\n'
+                           for stack, count in self.stacks.most_common())
+
+
+profiler = Profiler()
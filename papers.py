@@ -1,126 +1,796 @@
 #!/usr/bin/env python
 
+import argparse
+import itertools
 import json
 import logging
+import signal
+import socketserver
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from wsgiref import simple_server
 
 import falcon
+import numpy as np
 import requests
 
 import os
-import pickle
 
-from sentence_transformers import SentenceTransformer
-import scipy
+import ann
+import batching
+import cache
+import corpus
+import dedup
+import embeddings
+import encoder
+import lexical
+import metrics
+import passages
+import prefork
+import quantize
+import render
+import rerank
+import search
 
 HOST = '0.0.0.0'
 PORT = 8000
-RETURN_DEFAULT = 500
+# page size when the request has no limit
+RETURN_DEFAULT = 20
+# deepest result (offset + limit) a question can reach
 RETURN_LIMIT = 2000
+BATCH_LIMIT = 100
+BATCH_BODY_LIMIT = 256 * 1024
+# coalesce concurrent /papers questions into one encode + scoring pass,
+# set MICRO_BATCH_SIZE = 1 to answer every request on its own
+MICRO_BATCH_SIZE = batching.MAX_BATCH_SIZE
+MICRO_BATCH_WAIT = batching.MAX_WAIT
 
 DATA_PATH = 'data'
 MODELS_PATH = 'models'
 MODEL_NAME = 'scibert-nli'
+# models to choose from with model= (see download_model.py): the default one
+# loads at startup, the others on first use; model=ensemble fuses the
+# rankings of all of them whose files are there
+MODELS = ('scibert-nli', 'biobert-nli', 'covidbert-nli')
+MODEL_ENSEMBLE = 'ensemble'
+# bytes of the models loaded on first use (weights + embeddings), the least
+# recently used are unloaded beyond that; the default model doesn't count
+MODELS_MEMORY_BUDGET = 4 * 1024 * 1024 * 1024
+# reciprocal rank fusion of the ensemble, larger flattens the rank weights
+ENSEMBLE_RRF_K = 60
+# cross-encoder re-ordering the first RERANK_TOP_N rows of every ranking,
+# e.g. 'ms-marco-minilm' from `python download_model.py --model
+# ms-marco-minilm`, None to rank by embedding similarity only
+RERANK_MODEL = None
+RERANK_QUANTIZE = False
+RERANK_TOP_N = rerank.TOP_N
+# seconds a batch of questions may spend in the cross-encoder, rankings not
+# rescored in time keep the first-stage order
+RERANK_BUDGET = rerank.TIME_BUDGET
 CORPUS_PATH = os.path.join(DATA_PATH, 'corpus.pkl')
 MODEL_PATH = os.path.join(MODELS_PATH, MODEL_NAME)
 EMBEDDINGS_PATH = os.path.join(DATA_PATH, f'{MODEL_NAME}-embeddings.pkl')
+RERANK_PATH = os.path.join(MODELS_PATH, RERANK_MODEL) if RERANK_MODEL else None
+# built with `python ann.py --model scibert-nli`, exact search if missing
+INDEX_PATH = ann.index_path(EMBEDDINGS_PATH)
+NPROBE = ann.NPROBE_DEFAULT
+# 'float16', 'int8' or 'pq' to search compressed codes built with
+# `python quantize.py --mode int8` and re-rank with the exact vectors,
+# takes precedence over the IVF index
+QUANTIZATION = None
+# search title and abstract passages built with `python passages.py` (or
+# `python ingest.py --passages`), a paper scores the max or the mean of
+# the top PASSAGE_TOP_M of its passages; takes precedence over the above
+PASSAGES = False
+PASSAGE_POOLING = passages.POOLING
+PASSAGE_TOP_M = passages.TOP_M
+# int8 linear layers for the query encoder, check the embedding drift with
+# `python encoder.py --quantize` first (or point MODEL_PATH at the variant
+# saved by `python download_model.py --quantize`)
+ENCODER_QUANTIZE = False
+# torch threads for a single process server, prefork sets its own per worker
+ENCODER_THREADS = None
+QUERY_MAX_SEQ_LENGTH = encoder.QUERY_MAX_SEQ_LENGTH
+
+# mode=semantic|lexical|hybrid on /papers; lexical and hybrid need the BM25
+# index built by `python ingest.py` (or `python lexical.py`) and fall back
+# to semantic search without it
+SEARCH_MODES = ('semantic', 'lexical', 'hybrid')
+SEARCH_MODE_DEFAULT = batching.MODE_DEFAULT
+# hybrid score = HYBRID_WEIGHT * cosine + (1 - HYBRID_WEIGHT) * relative BM25
+HYBRID_WEIGHT = 0.7
+# best BM25 matches the dense scoring of a hybrid question is restricted to
+HYBRID_CANDIDATES = 2000
 
 UID_LEN = 8
-
-
-class AnswerEngine(object):
-
-    def __init__(self, corpus_path, model_path, embeds_path):
+# near-duplicates clustered by `python ingest.py` (or `python dedup.py`)
+# come back as one result, the latest version that passes the filters,
+# listing the others under "versions"
+COLLAPSE_VERSIONS = True
+
+# query -> embedding, bounded in bytes, entries never expire
+EMBED_CACHE_BYTES = 64 * 1024 * 1024
+EMBED_CACHE_TTL = None
+# query + filters + mode -> ranked row ids and scores, pages are sliced
+# from them; ranked RANK_DEPTH deep at first, deeper pages rank further
+RANKING_CACHE_BYTES = 64 * 1024 * 1024
+RANKING_CACHE_TTL = 60 * 60
+RANK_DEPTH = 200
+# row -> pre-rendered JSON of the paper, responses concatenate them
+FRAGMENT_CACHE_BYTES = 128 * 1024 * 1024
+FRAGMENT_CACHE_TTL = None
+# gzip/deflate responses for clients that accept it
+COMPRESSION = True
+# run through the model and the index before reporting ready, the first
+# torch calls allocate buffers and pick kernels
+WARMUP_QUERIES = ['coronavirus', 'incubation period of covid-19 in children']
+WARMUP_TOP_K = 10
+# seconds clients should wait before retrying while the engine loads
+STARTUP_RETRY_AFTER = 10
+
+
+REQUEST_SECONDS = metrics.Histogram(
+    'papers_request_seconds', 'Request latency.', ('route',))
+REQUESTS = metrics.Counter(
+    'papers_requests_total', 'Requests answered.', ('route', 'status'))
+QUESTIONS = metrics.Counter(
+    'papers_questions_total', 'Questions asked, by mode and whether their '
+    'ranking came from the cache.', ('mode', 'ranking'))
+CANDIDATE_ROWS = metrics.Counter(
+    'papers_candidate_rows_total', 'Rows left to rank after the filters.')
+RETURNED_ROWS = metrics.Counter(
+    'papers_returned_rows_total', 'Rows returned in pages.')
+RERANKS = metrics.Counter(
+    'papers_reranks_total', 'Rankings re-ordered by the cross-encoder, or '
+    'left in first-stage order when out of time.', ('outcome',))
+
+
+def model_paths(name):
+    """
+    Model directory and embeddings of a model, laid out as download_model.py
+    and ingest.py write them.
+    """
+    return (os.path.join(MODELS_PATH, name),
+            os.path.join(DATA_PATH, f'{name}-embeddings.pkl'))
+
+
+class AnswerData(object):
+    """
+    Corpus, embeddings of the default model and the indexes built over
+    them. They always change together, so the engine swaps them as one
+    object on reload. Rankings hold row ids of the version they were
+    computed on.
+    """
+    versions = itertools.count()
+
+    def __init__(self, corpus_path, embeds_path, index_path=None, nprobe=NPROBE,
+                 quantization=QUANTIZATION):
+        self.version = next(AnswerData.versions)
         print(f'Load corpus from "{corpus_path}"...')
-        if not os.path.exists(corpus_path):
+        if not corpus.exists(corpus_path):
             raise AnswerError(f'Can\'t find corpus.')
-        with open(corpus_path, 'rb') as f:
-            self.corpus = pickle.load(f)
-        item0_cord_uuid = self.corpus[0][7]
+        self.corpus = corpus.load(corpus_path)
+        self.valid_uids = self.corpus.valid_uids(UID_LEN)
+        self.filter_index = corpus.FilterIndex(self.corpus)
+        item0_cord_uuid = self.corpus.get('cord_uid', 0)
         if not AnswerEngine.is_cord_uid(item0_cord_uuid):
             raise AnswerError('Wrong corpus or corrupted data.')
 
-        print(f'Load model from "{model_path}"...')
-        if not os.path.exists(model_path):
-            raise AnswerError(f'Can\'t find model.')
-        self.model = SentenceTransformer(model_path)
-
+        lexical_path = lexical.index_path(corpus_path)
+        self.lexical = None
+        if os.path.exists(lexical_path):
+            print(f'Load BM25 index from "{lexical_path}"...')
+            self.lexical = lexical.load(lexical_path)
+            if len(self.lexical) != len(self.corpus):
+                raise AnswerError('Corpus and BM25 index don\'t match.')
+
+        duplicates_path = dedup.index_path(corpus_path)
+        self.duplicates = None
+        if COLLAPSE_VERSIONS and os.path.exists(duplicates_path):
+            print(f'Load near-duplicates from "{duplicates_path}"...')
+            self.duplicates = dedup.load(duplicates_path)
+            if len(self.duplicates) != len(self.corpus):
+                raise AnswerError('Corpus and near-duplicates don\'t match.')
+
+        # embeddings of the default model, other models bring their own
+        self.model_data = ModelData(embeds_path, len(self.corpus), index_path,
+                                    nprobe, quantization)
+
+
+class ModelData(object):
+    """
+    Corpus embeddings of one model and the index searched over them.
+    """
+
+    def __init__(self, embeds_path, size, index_path=None, nprobe=NPROBE,
+                 quantization=QUANTIZATION, passage_search=PASSAGES):
+        passages_path = embeds_path
+        # memory-mapped store built with `python embeddings.py`, preferred
+        if os.path.exists(embeddings.npy_path(embeds_path)):
+            embeds_path = embeddings.npy_path(embeds_path)
         print(f'Load embeddings from "{embeds_path}"...')
         if not os.path.exists(embeds_path):
             raise AnswerError(f'Can\'t find embeddings.')
-        with open(embeds_path, 'rb') as f:
-            self.embeds = pickle.load(f)
+        self.embeds = embeddings.load(embeds_path)
+        if len(self.embeds) != size:
+            raise AnswerError('Corpus and embeddings don\'t match.')
 
+        try:
+            if passage_search:
+                print(f'Load passages of "{passages_path}"...')
+                if not passages.exists(passages_path):
+                    raise AnswerError(f'Can\'t find passages.')
+                store = passages.PassageStore.load(passages_path)
+                if len(store) != size:
+                    raise AnswerError('Corpus and passages don\'t match.')
+                self.index = passages.PassageIndex(store, PASSAGE_POOLING,
+                                                   PASSAGE_TOP_M)
+            elif quantization is not None:
+                codes_path = quantize.codes_path(embeds_path, quantization)
+                print(f'Load {quantization} codes from "{codes_path}"...')
+                if not os.path.exists(codes_path):
+                    raise AnswerError(f'Can\'t find {quantization} codes.')
+                self.index = quantize.QuantizedIndex(
+                    self.embeds, quantize.load(codes_path))
+            else:
+                if index_path is not None and os.path.exists(index_path):
+                    print(f'Load index from "{index_path}"...')
+                self.index = ann.load_index(self.embeds, index_path, nprobe)
+        except ValueError as ex:
+            raise AnswerError(format(ex))
+
+    def nbytes(self):
+        """
+        Size of the embeddings (mapped or not), of the passages and of the
+        quantized codes.
+        """
+        total = self.embeds.nbytes
+        if isinstance(self.index, passages.PassageIndex):
+            total += self.index.store.nbytes()
+        codes = getattr(self.index, 'codes', None)
+        if codes is not None:
+            total += quantize.nbytes(codes)
+        return total
+
+    def similarity(self, rows, query_embed):
+        """
+        Scores of the given rows, pooled over their passages when those are
+        searched.
+        """
+        if isinstance(self.index, passages.PassageIndex):
+            return self.index.similarity(query_embed, rows)
+        return search.similarity(self.embeds[rows], query_embed)
+
+
+class Model(object):
+    """
+    A query encoder next to the embeddings it produced for one version of
+    the data.
+    """
+
+    def __init__(self, name, encoder, data, version):
+        self.name = name
+        self.encoder = encoder
+        self.data = data
+        self.version = version
+
+    def nbytes(self):
+        return self.encoder.nbytes() + self.data.nbytes()
+
+
+class Results(object):
+    """
+    A page of ranked rows, only turned into JSON by format_results.
+    """
+
+    def __init__(self, data, ids, scores, timings=()):
+        self.data = data
+        self.ids = ids
+        self.scores = scores
+        # (stage, seconds) of the batch that answered it
+        self.timings = timings
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class AnswerEngine(object):
+    """
+    Created empty, so the app can answer liveness checks right away; the
+    data and the model are loaded by load() (or in the background by
+    start()) and questions are refused until the engine is ready.
+    """
+
+    def __init__(self, corpus_path, model_path, embeds_path,
+                 index_path=None, nprobe=NPROBE, quantization=QUANTIZATION,
+                 model_name=MODEL_NAME, models={},
+                 models_budget=MODELS_MEMORY_BUDGET, reranker_path=None):
+        self.paths = (corpus_path, embeds_path, index_path, nprobe, quantization)
+        self.model_path = model_path
+        self.model_name = model_name
+        self.reranker_path = reranker_path
+        self.data = None
+        self.model = None
+        self.reranker = None
+        # name -> (model path, embeddings path) of the models loaded on demand
+        self.models = {name: paths for name, paths in models.items()
+                       if name != model_name}
+        self.model_pool = cache.LRUCache(models_budget,
+                                         sizeof=lambda model: model.nbytes())
+        self.model_locks = {name: threading.Lock() for name in self.models}
+        self.error = None
+        self.ready = threading.Event()
+        self.loader = None
+        self.start_lock = threading.Lock()
+
+        self.embed_cache = cache.LRUCache(EMBED_CACHE_BYTES, EMBED_CACHE_TTL)
+        self.ranking_cache = cache.LRUCache(RANKING_CACHE_BYTES,
+                                            RANKING_CACHE_TTL)
+        self.renderer = render.Renderer(FRAGMENT_CACHE_BYTES, FRAGMENT_CACHE_TTL)
+
+    def start(self, warmup=WARMUP_QUERIES):
+        """
+        Load in the background; only the first call starts loading.
+        """
+        with self.start_lock:
+            if self.loader is not None:
+                return
+            self.loader = threading.Thread(target=self.load, args=(warmup,),
+                                           name='loader', daemon=True)
+            self.loader.start()
+
+    def wait(self, timeout=None):
+        """
+        Block until a load started by start() is over, True if it succeeded.
+        """
+        if self.loader is not None:
+            self.loader.join(timeout)
+        return self.ready.is_set()
+
+    def load(self, warmup=WARMUP_QUERIES):
+        """
+        Load the data and the model side by side, both spend most of their
+        time in disk reads and native code, then warm them up.
+        """
+        try:
+            with ThreadPoolExecutor(3, thread_name_prefix='load') as pool:
+                data = pool.submit(AnswerData, *self.paths)
+                model = pool.submit(self.load_model, self.model_path)
+                reranker = pool.submit(self.load_reranker, self.reranker_path)
+                self.data, self.model = data.result(), model.result()
+                self.reranker = reranker.result()
+            self.warmup(warmup)
+        except Exception as ex:
+            self.error = ex
+            print(f'Answer engine failed to start: {ex}')
+            return False
+        self.ready.set()
         print('Answer engine initialized.')
+        return True
 
-    def ask_question(self, query, filters={}, top_k=RETURN_DEFAULT):
-        queries = [query]  # only one query at the moment
-        query_embeds = self.model.encode(queries, show_progress_bar=False)
-        results = []
-        count = 0
-        for query, query_embed in zip(queries, query_embeds):
-            distances = scipy.spatial.distance.cdist(
-                [query_embed], self.embeds, "cosine")[0]
-            distances = zip(range(len(distances)), distances)
-            distances = sorted(distances, key=lambda x: x[1])
-            for idx, distance in distances:
-                item_raw = self.corpus[idx]
-                if not AnswerEngine.is_cord_uid(item_raw[7]):
-                    # skip invalid item
-                    continue
-                item = dict(
-                    cord_uid=item_raw[7],
-                    title=item_raw[3],
-                    abstract=item_raw[0],
-                    date=item_raw[1],
-                    # random.choice(['en','zh','fr','de','es','it','pt','ja']),
-                    lang=item_raw[2],
-                    url=item_raw[4],
-                    theme=item_raw[5],
-                    sub_theme=item_raw[6],
-                )
-                if self.check_constraints(item, filters):
-                    count += 1
-                    results.append({
-                        'score': round((1 - distance)*10, 3),  # 0.000 - 10.000
-                        **item
-                    })
-                if count >= top_k:
-                    break
-        return results
-
-    def check_constraints(self, data, filters):
-        for key in data.keys() & filters.keys():
-            if not filters[key](data[key]):
-                return False
+    @staticmethod
+    def load_model(model_path):
+        print(f'Load model from "{model_path}"...')
+        if not os.path.exists(model_path):
+            raise AnswerError(f'Can\'t find model.')
+        return encoder.QueryEncoder(model_path, ENCODER_QUANTIZE,
+                                    ENCODER_THREADS, QUERY_MAX_SEQ_LENGTH)
+
+    @staticmethod
+    def load_reranker(reranker_path):
+        if reranker_path is None:
+            return None
+        print(f'Load re-ranker from "{reranker_path}"...')
+        if not os.path.exists(reranker_path):
+            raise AnswerError(f'Can\'t find re-ranker.')
+        return rerank.CrossEncoderReranker(reranker_path, RERANK_QUANTIZE)
+
+    def warmup(self, queries):
+        """
+        Encode the queries one by one and as a batch and search the index
+        with them, bypassing the caches.
+        """
+        if not queries:
+            return
+        print('Warm up...')
+        for batch in [[query] for query in queries] + [list(queries)]:
+            query_embeds = search.normalize(
+                self.model.encode(batch, show_progress_bar=False))
+            hits = self.data.model_data.index.iter_search_batch(
+                query_embeds, [WARMUP_TOP_K] * len(batch),
+                [self.data.valid_uids] * len(batch))
+            for query, query_hits in zip(batch, hits):
+                ids, scores = self.ranked(query_hits, WARMUP_TOP_K)
+                if self.reranker is not None:
+                    self.reranker.rerank(self.data.corpus, self.data.version,
+                                         [(query, ids, scores)], budget=None)
+                self.format_results(self.collect_results(self.data, ids,
+                                                         scores))
+        if self.data.lexical is not None:
+            for query in queries:
+                self.data.lexical.scores(query)
+        if self.reranker is not None:
+            self.reranker.cache.clear()
+
+    def check_ready(self):
+        if not self.ready.is_set():
+            raise NotReadyError('The answer engine is still loading.'
+                                if self.error is None else
+                                'The answer engine failed to start.')
+
+    def reload(self):
+        """
+        Load the current corpus, embeddings and index (e.g. after
+        `python ingest.py`) and swap them in at once. Questions already
+        running finish on the previous data, on failure it stays in use.
+        """
+        if not self.ready.is_set():
+            print('Reload skipped, the engine is not ready.')
+            return False
+        try:
+            data = AnswerData(*self.paths)
+        except AnswerError as ex:
+            print(f'Reload failed: {ex}')
+            return False
+        self.data = data
+        self.ranking_cache.clear()
+        self.renderer.clear()
+        # the other models load again for the new data on first use
+        self.model_pool.clear()
+        print('Answer engine reloaded.')
         return True
 
-    def format_results(self, results):
-        papers = []
-        langs = {}
-        for item in results:
-            papers.append({
-                'cord_uid': item['cord_uid'],
-                'score': item['score'],
-                ** ({'title': item['title']} if not AnswerEngine.is_null(item['title']) else {}),
-                # strip abstract
-                ** ({'abstract': item['abstract'].strip()} if not AnswerEngine.is_null(item['abstract']) else {}),
-                ** ({'date': item['date']} if not AnswerEngine.is_null(item['date']) else {}),
-                ** ({'lang': item['lang']} if not AnswerEngine.is_null(item['lang']) else {}),
-                ** ({'url': item['url']} if not AnswerEngine.is_null(item['url']) else {}),
-                ** ({'theme': item['theme']} if not AnswerEngine.is_null(item['theme']) else {}),
-                ** ({'sub_theme': item['sub_theme']} if not AnswerEngine.is_null(item['sub_theme']) else {}),
-            })
-            if item['lang'] in langs:
-                langs[item['lang']] += 1
+    def ask_question(self, query, filters={}, top_k=RETURN_DEFAULT,
+                     mode=SEARCH_MODE_DEFAULT, offset=0, model=None):
+        return self.ask_questions(
+            [(query, filters, top_k, mode, offset, model)])[0]
+
+    def ask_questions(self, questions):
+        """
+        Answer a batch of (query, filters, limit, mode, offset, model)
+        questions, model None for the default one.
+        The ranked row ids of a query + filters + mode are computed once, a
+        few pages deep, and kept in the ranking cache; a page only slices
+        them and materializes its rows.
+        """
+        self.check_ready()
+        with metrics.recording() as timings:
+            answers = self._ask_questions(questions)
+        # the stages of the whole batch, for the Server-Timing of each request
+        for answer in answers:
+            answer.timings = timings
+        return answers
+
+    def _ask_questions(self, questions):
+        # one consistent view even if a reload swaps the data meanwhile
+        data = self.data
+        questions = [(query, filters, limit, mode, offset, model or self.model_name)
+                     for query, filters, limit, mode, offset, model in questions]
+        keys = [cache.question_key(query, filters, mode, model)
+                for query, filters, _, mode, _, model in questions]
+        rankings = [self.ranking_cache.get(key) for key in keys]
+        missing = [
+            i for i, (ranking, (_, _, limit, _, offset, _))
+            in enumerate(zip(rankings, questions))
+            if not self.covers(ranking, data, offset + limit)
+        ]
+        for i, (_, _, _, mode, _, _) in enumerate(questions):
+            QUESTIONS.inc(mode=mode, ranking='miss' if i in missing else 'hit')
+        if missing:
+            ranked = self.rank(data, [
+                (query, filters, min(max(RANK_DEPTH, 2 * (offset + limit)),
+                                     RETURN_LIMIT), mode, model)
+                for query, filters, limit, mode, offset, model
+                in (questions[i] for i in missing)
+            ])
+            complete = [True] * len(ranked)
+            if self.reranker is not None:
+                ranked, complete = self.rerank(
+                    data, [questions[i][0] for i in missing], ranked)
+            for i, ranking, keep in zip(missing, ranked, complete):
+                rankings[i] = ranking
+                # first-stage order after running out of time is not kept,
+                # the question gets re-ranked when asked again
+                if keep:
+                    self.ranking_cache.put(keys[i], ranking)
+
+        answers = []
+        for (_, _, limit, _, offset, _), ranking in zip(questions, rankings):
+            _, _, ids, scores = ranking
+            page = slice(offset, offset + limit)
+            answers.append(self.collect_results(data, ids[page], scores[page]))
+        RETURNED_ROWS.inc(sum(len(answer) for answer in answers))
+        return answers
+
+    @staticmethod
+    def covers(ranking, data, end):
+        """
+        Whether a cached (version, depth, ids, scores) ranking holds the
+        rows up to `end`: it was ranked on the current data and is either
+        deep enough or holds every matching row.
+        """
+        if ranking is None:
+            return False
+        version, depth, ids, _ = ranking
+        return version == data.version and (len(ids) >= end or len(ids) < depth)
+
+    def rank(self, data, questions):
+        """
+        Rankings of a batch of (query, filters, depth, mode, model)
+        questions with one model forward pass and one scoring pass over the
+        corpus per model. Ensemble questions are ranked by every available
+        model and fused.
+        """
+        if data.lexical is None:
+            questions = [(query, filters, depth, 'semantic', model)
+                         for query, filters, depth, _, model in questions]
+        # invalid items and filtered out items are excluded before scoring
+        with metrics.stage('filter'):
+            masks = [
+                data.filter_index.mask(filters, data.valid_uids)
+                for _, filters, _, _, _ in questions
+            ]
+            CANDIDATE_ROWS.inc(int(sum(mask.sum() for mask in masks)))
+
+        # lexical questions are the same whatever the model
+        names = [
+            [self.model_name] if mode == 'lexical' else
+            self.available_models() if model == MODEL_ENSEMBLE else [model]
+            for _, _, _, mode, model in questions
+        ]
+        asked = {}
+        for i, question_names in enumerate(names):
+            for name in question_names:
+                asked.setdefault(name, []).append(i)
+        # all models first, an unavailable one fails before any encoding
+        models = {name: self.get_model(data, name) for name in asked}
+        ranked = {}
+        for name, ids in asked.items():
+            for i, ranking in zip(ids, self.rank_model(
+                    data, models[name], [questions[i] for i in ids],
+                    [masks[i] for i in ids])):
+                ranked[i, name] = ranking
+
+        rankings = []
+        for i, (_, _, depth, _, model) in enumerate(questions):
+            if model == MODEL_ENSEMBLE and len(names[i]) > 1:
+                ids, scores = self.fuse(
+                    [ranked[i, name] for name in names[i]], depth)
+                # models may have picked different versions of a paper
+                ids, scores = self.ranked(self.collapse(
+                    data, zip(ids.tolist(), scores.tolist()), masks[i]), depth)
             else:
-                langs[item['lang']] = 1
+                ids, scores = ranked[i, names[i][0]]
+            rankings.append((data.version, depth, ids, scores))
+        return rankings
+
+    def rank_model(self, data, model, questions, masks):
+        """
+        (ids, scores) of questions for one model, their masks applied.
+        """
+        dense = [i for i, question in enumerate(questions)
+                 if question[3] != 'lexical']
+        query_embeds = dict(zip(dense, self.encode(
+            model, [questions[i][0] for i in dense]))) if dense else {}
+
+        # hits are lazy, the scoring happens while the rankings are taken
+        with metrics.stage('search'):
+            hits = {}
+            semantic = [i for i in dense if questions[i][3] == 'semantic']
+            if semantic:
+                hits.update(zip(semantic, model.data.index.iter_search_batch(
+                    [query_embeds[i] for i in semantic],
+                    [questions[i][2] for i in semantic],
+                    [masks[i] for i in semantic])))
+            for i, (query, _, depth, mode, _) in enumerate(questions):
+                if mode == 'lexical':
+                    hits[i] = data.lexical.iter_search(query, depth, masks[i])
+                elif mode == 'hybrid':
+                    hits[i] = self.hybrid_search(data, model.data, query,
+                                                 query_embeds[i], depth,
+                                                 masks[i])
+            return [
+                self.ranked(self.collapse(data, hits[i], masks[i]), depth)
+                for i, (_, _, depth, _, _) in enumerate(questions)
+            ]
+
+    @staticmethod
+    def fuse(rankings, depth):
+        """
+        Reciprocal rank fusion of (ids, scores) rankings: a row scores the
+        sum of 1 / (ENSEMBLE_RRF_K + rank) over the rankings holding it,
+        relative to a row ranked first by all so scores fall in (0, 1].
+        """
+        ids = np.concatenate([ids for ids, _ in rankings])
+        ranks = np.concatenate([np.arange(len(ids)) for ids, _ in rankings])
+        rows, inverse = np.unique(ids, return_inverse=True)
+        scores = np.bincount(inverse, weights=1 / (ENSEMBLE_RRF_K + 1 + ranks),
+                             minlength=len(rows))
+        scores *= (ENSEMBLE_RRF_K + 1) / len(rankings)
+        top = search.top_k(scores, depth)
+        return rows[top], scores[top].astype(np.float32)
+
+    def available_models(self):
+        """
+        The default model and the others whose model and embeddings exist.
+        """
+        return [self.model_name] + [
+            name for name, (model_path, embeds_path) in self.models.items()
+            if os.path.exists(model_path) and (
+                os.path.exists(embeds_path)
+                or os.path.exists(embeddings.npy_path(embeds_path)))
+        ]
+
+    def get_model(self, data, name):
+        """
+        The model by name, with its embeddings for `data`. Models other
+        than the default are loaded on first use, one at a time, and kept
+        in the model pool while they fit its memory budget.
+        """
+        if name == self.model_name:
+            return Model(name, self.model, data.model_data, data.version)
+        if name not in self.available_models():
+            raise AnswerError(f'Model {name} is not available.')
+        model = self.model_pool.get(name)
+        if model is not None and model.version == data.version:
+            return model
+        with self.model_locks[name]:
+            # loaded by another thread meanwhile
+            model = self.model_pool.get(name)
+            if model is not None and model.version == data.version:
+                return model
+            model_path, embeds_path = self.models[name]
+            _, _, _, nprobe, quantization = self.paths
+            model = Model(
+                name,
+                model.encoder if model is not None else self.load_model(model_path),
+                ModelData(embeds_path, len(data.corpus),
+                          ann.index_path(embeds_path), nprobe, quantization),
+                data.version)
+            if model.nbytes() > self.model_pool.max_bytes:
+                print(f'Model {name} exceeds MODELS_MEMORY_BUDGET, '
+                      f'it is loaded again for every batch.')
+            self.model_pool.put(name, model)
+            return model
+
+    def rerank(self, data, queries, rankings):
+        """
+        Rankings with their head re-ordered by the cross-encoder within
+        RERANK_BUDGET, and whether each of them was.
+        """
+        with metrics.stage('rerank'):
+            reranked = self.reranker.rerank(
+                data.corpus, data.version,
+                [(query, ids, scores)
+                 for query, (_, _, ids, scores) in zip(queries, rankings)],
+                RERANK_TOP_N, RERANK_BUDGET)
+        results, complete = [], []
+        for (version, depth, _, _), (ids, scores, done) in zip(rankings,
+                                                                reranked):
+            RERANKS.inc(outcome='reranked' if done else 'fallback')
+            results.append((version, depth, ids, scores))
+            complete.append(done)
+        return results, complete
+
+    @staticmethod
+    def collapse(data, hits, mask):
+        """
+        Hits with the versions of a paper collapsed into one, after the
+        filters so an older version still answers when the latest is
+        filtered out.
+        """
+        if data.duplicates is None:
+            return hits
+        return data.duplicates.collapse(hits, mask, data.corpus.dates['date'])
+
+    @staticmethod
+    def ranked(hits, depth):
+        """
+        The first `depth` (idx, score) hits as (ids, scores) arrays.
+        """
+        hits = list(itertools.islice(hits, max(depth, 0)))
+        return (np.array([idx for idx, _ in hits], dtype=np.int64),
+                np.array([score for _, score in hits], dtype=np.float32))
+
+    def hybrid_search(self, data, model_data, query, query_embed, top_k, mask):
+        """
+        Fused cosine + BM25 scores. The dense scoring only covers the best
+        BM25 matches; when there are fewer than top_k of them the best
+        semantic matches are added, with no lexical score.
+        """
+        rows, lexical_scores = data.lexical.scores(query, mask)
+        if len(rows) > HYBRID_CANDIDATES:
+            keep = np.sort(search.top_k(lexical_scores, HYBRID_CANDIDATES))
+            rows, lexical_scores = rows[keep], lexical_scores[keep]
+        if len(rows):
+            lexical_scores /= lexical_scores.max()
+        if len(rows) < top_k:
+            semantic = np.setdiff1d(np.fromiter(
+                (idx for idx, _ in itertools.islice(
+                    model_data.index.iter_search(query_embed, top_k, mask),
+                    top_k)),
+                dtype=np.int64), rows)
+            order = np.argsort(np.concatenate((rows, semantic)), kind='stable')
+            rows = np.concatenate((rows, semantic))[order]
+            lexical_scores = np.concatenate(
+                (lexical_scores, np.zeros(len(semantic), np.float32)))[order]
+        if not len(rows):
+            return
+        # rows are ascending, the memory-mapped vectors are read in order
+        scores = HYBRID_WEIGHT * model_data.similarity(rows, query_embed) \
+            + (1 - HYBRID_WEIGHT) * lexical_scores
+        for i in search.iter_top_k(scores, top_k):
+            yield int(rows[i]), float(scores[i])
+
+    def encode(self, model, queries):
+        """
+        Normalized query embeddings, only queries missing from the embedding
+        cache go through the model.
+        """
+        queries = [cache.normalize_query(query) for query in queries]
+        embeds = {query: self.embed_cache.get((model.name, query))
+                  for query in queries}
+        missing = [query for query, embed in embeds.items() if embed is None]
+        if missing:
+            with metrics.stage('encode'):
+                missing_embeds = search.normalize(
+                    model.encoder.encode(missing, show_progress_bar=False))
+            for query, embed in zip(missing, missing_embeds):
+                embeds[query] = embed.copy()
+                self.embed_cache.put((model.name, query), embeds[query])
+        return np.stack([embeds[query] for query in queries])
+
+    def cache_stats(self):
         return {
-            'langs': langs,
-            'papers': papers,
+            'embeddings': self.embed_cache.stats(),
+            'rankings': self.ranking_cache.stats(),
+            'fragments': self.renderer.stats(),
+            'models': self.model_pool.stats(),
+            **({'pairs': self.reranker.cache.stats()}
+               if self.reranker is not None else {}),
         }
 
+    def collect_results(self, data, ids, scores):
+        return Results(data, ids, scores)
+
+    def format_results(self, results):
+        with metrics.stage('render'):
+            return {
+                'langs': render.langs(results.data.corpus, results.ids),
+                'papers': self.renderer.papers(results.data, results.ids,
+                                               results.scores),
+            }
+
+    def memory(self):
+        """
+        Bytes held by the model and by each part of the data; memory-mapped
+        parts count their mapped size.
+        """
+        data = self.data
+        parts = {}
+        if self.model is not None and hasattr(self.model, 'nbytes'):
+            parts['model'] = self.model.nbytes()
+        if data is not None:
+            parts['embeddings'] = data.model_data.embeds.nbytes
+            if data.lexical is not None:
+                parts['bm25'] = sum(array.nbytes for array in (
+                    data.lexical.postings, data.lexical.tfs,
+                    data.lexical.offsets, data.lexical.df))
+            codes = getattr(data.model_data.index, 'codes', None)
+            if codes is not None:
+                parts['codes'] = quantize.nbytes(codes)
+            if isinstance(data.model_data.index, passages.PassageIndex):
+                parts['passages'] = data.model_data.index.store.nbytes()
+            if data.duplicates is not None:
+                parts['duplicates'] = data.duplicates.nbytes()
+        # weights and embeddings of the models loaded on demand
+        parts['models'] = self.model_pool.stats()['bytes']
+        if self.reranker is not None:
+            parts['reranker'] = self.reranker.nbytes()
+        return parts
+
     @staticmethod
     def is_cord_uid(uid):
         return type(uid) is str and len(uid) == UID_LEN
@@ -140,6 +810,24 @@ class AnswerError(Exception):
                                'Answer Engine Error',
                                description)
 
+    @staticmethod
+    async def handle_async(req, resp, ex, params):
+        # the ASGI app only adapts the legacy (ex, ...) order of sync handlers
+        AnswerError.handle(ex, req, resp, params)
+
+
+class NotReadyError(AnswerError):
+
+    @staticmethod
+    def handle(ex, req, resp, params):
+        raise falcon.HTTPServiceUnavailable(title='Not Ready',
+                                            description=format(ex),
+                                            retry_after=STARTUP_RETRY_AFTER)
+
+    @staticmethod
+    async def handle_async(req, resp, ex, params):
+        NotReadyError.handle(ex, req, resp, params)
+
 
 # class StorageEngine(object):
 
@@ -164,13 +852,28 @@ class AnswerError(Exception):
 
 
 class HealthSink(object):
+    """
+    /health/ready: 200 once the engine answers questions, 503 while it
+    loads. /health and anything else below it is the liveness check, it
+    only fails when loading failed for good.
+    """
 
-    def __call__(self, req, resp):
+    def __init__(self, db):
+        self.db = db
 
+    def __call__(self, req, resp, **kwargs):
         resp.content_type = 'text/plain'
-        resp.body = 'Papers-19'
         resp.set_header('Powered-By', 'Papers')
-        resp.status = falcon.HTTP_200
+        if self.db.error is not None:
+            resp.body = 'Failed to start'
+            resp.status = falcon.HTTP_503
+        elif (req.path.rstrip('/') == '/health/ready'
+              and not self.db.ready.is_set()):
+            resp.body = 'Loading'
+            resp.status = falcon.HTTP_503
+        else:
+            resp.body = 'Papers-19'
+            resp.status = falcon.HTTP_200
 
 
 # class SinkAdapter(object):
@@ -197,6 +900,7 @@ class AuthMiddleware(object):
         if not (
             req.method == 'OPTIONS'
             or req.path == '/health' or req.path.startswith('/health/')
+            or req.path == '/metrics'
         ):
             token = req.get_header('Authorization')
             account_id = req.get_header('Account-ID')
@@ -221,6 +925,9 @@ class AuthMiddleware(object):
                                               challenges,
                                               href='http://docs.example.com/auth')
 
+    async def process_request_async(self, req, resp):
+        self.process_request(req, resp)
+
     def _token_is_valid(self, token, account_id):
         return account_id == 'bin' and token == 'ZHANG'
 
@@ -239,6 +946,9 @@ class RequireJSON(object):
                     'This API only supports requests encoded as JSON.',
                     href='http://docs.examples.com/api/json')
 
+    async def process_request_async(self, req, resp):
+        self.process_request(req, resp)
+
 
 class JSONTranslator(object):
     # NOTE: Starting with Falcon 1.3, you can simply
@@ -253,13 +963,24 @@ class JSONTranslator(object):
             # Nothing to do
             return
 
-        body = req.stream.read()
+        body = req.stream.read(req.content_length)
+        req.context.doc = self.load_doc(body)
+
+    async def process_request_async(self, req, resp):
+        # ASGI variant, the stream has to be awaited
+        if req.content_length in (None, 0):
+            return
+
+        body = await req.stream.read()
+        req.context.doc = self.load_doc(body)
+
+    def load_doc(self, body):
         if not body:
             raise falcon.HTTPBadRequest('Empty request body',
                                         'A valid JSON document is required.')
 
         try:
-            req.context.doc = json.loads(body.decode('utf-8'))
+            return json.loads(body.decode('utf-8'))
 
         except (ValueError, UnicodeDecodeError):
             raise falcon.HTTPError(falcon.HTTP_753,
@@ -272,7 +993,80 @@ class JSONTranslator(object):
         if not hasattr(resp.context, 'result'):
             return
 
-        resp.body = json.dumps(resp.context.result)
+        with metrics.stage('serialize'):
+            resp.body = render.dumps(resp.context.result)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        self.process_response(req, resp, resource, req_succeeded)
+
+
+class StartupMiddleware(object):
+    """
+    Starts loading the engine with the server (ASGI lifespan startup) or its
+    first request, so importing the module (e.g. from benchmark.py) loads
+    nothing.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def process_request(self, req, resp):
+        self.db.start()
+
+    async def process_startup(self, scope, event):
+        self.db.start()
+
+    async def process_request_async(self, req, resp):
+        self.db.start()
+
+
+class MetricsMiddleware(object):
+    # first in the middleware list, so its process_response runs last: times
+    # everything, sets Server-Timing
+
+    def process_request(self, req, resp):
+        req.context.started = time.perf_counter()
+        req.context.timings_token = metrics.start_request()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if not hasattr(req.context, 'timings_token'):
+            return
+        total = time.perf_counter() - req.context.started
+        timings = metrics.end_request(req.context.timings_token)
+        resp.set_header('Server-Timing', metrics.server_timing(timings, total))
+        route = getattr(req, 'uri_template', None) or 'other'
+        REQUEST_SECONDS.observe(total, route=route)
+        REQUESTS.inc(route=route, status=str(resp.status).split()[0])
+
+    async def process_request_async(self, req, resp):
+        self.process_request(req, resp)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        self.process_response(req, resp, resource, req_succeeded)
+
+
+class CompressionMiddleware(object):
+    # after MetricsMiddleware and StartupMiddleware in the middleware list,
+    # so its process_response runs once JSONTranslator has set the body; the
+    # two that run after it don't touch the body
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if not COMPRESSION:
+            return
+        body = resp.body.encode('utf-8') if resp.body is not None else resp.data
+        if body is None or len(body) < render.COMPRESS_MIN_BYTES:
+            return
+        encoding = render.accepted_encoding(req.get_header('Accept-Encoding'))
+        resp.vary = ('Accept-Encoding',)
+        if encoding is None:
+            return
+        resp.body = None
+        with metrics.stage('compress'):
+            resp.data = render.compress(body, encoding)
+        resp.set_header('Content-Encoding', encoding)
+
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        self.process_response(req, resp, resource, req_succeeded)
 
 
 def max_body(limit):
@@ -314,6 +1108,9 @@ class CORSComponent(object):
                 ('Access-Control-Max-Age', '86400'),  # 24 hours
             ))
 
+    async def process_response_async(self, req, resp, resource, req_succeeded):
+        self.process_response(req, resp, resource, req_succeeded)
+
 
 # class ThingsResource(object):
 
@@ -366,6 +1163,135 @@ class CORSComponent(object):
 #         resp.location = '/%s/things/%s' % (user_id, proper_thing['id'])
 
 
+def parse_limit(limit):
+    if limit is not None and limit < 1:
+        raise falcon.HTTPBadRequest(
+            'Invalid limit', '"limit" must be at least 1.')
+    limit = limit or RETURN_DEFAULT
+    if limit > RETURN_LIMIT:
+        limit = RETURN_LIMIT
+    return limit
+
+
+def parse_offset(offset, limit):
+    """
+    Validated offset, and the limit cut so the page ends by RETURN_LIMIT.
+    """
+    offset = offset or 0
+    if offset < 0 or offset >= RETURN_LIMIT:
+        raise falcon.HTTPBadRequest(
+            'Invalid offset',
+            f'"offset" must be between 0 and {RETURN_LIMIT - 1}.')
+    return offset, min(limit, RETURN_LIMIT - offset)
+
+
+def page_info(offset, limit, results):
+    """
+    Offset of the page and of the next one, None after the last page.
+    """
+    more = len(results) == limit and offset + limit < RETURN_LIMIT
+    return {
+        'offset': offset,
+        'next_offset': offset + limit if more else None,
+    }
+
+
+def parse_mode(mode):
+    mode = mode or SEARCH_MODE_DEFAULT
+    if mode not in SEARCH_MODES:
+        raise falcon.HTTPBadRequest(
+            'Invalid mode',
+            '"mode" must be one of ' + ', '.join(SEARCH_MODES) + '.')
+    return mode
+
+
+def parse_model(model):
+    """
+    A model of MODELS or the ensemble, None for the default model.
+    """
+    if model is not None and model not in MODELS + (MODEL_ENSEMBLE,):
+        raise falcon.HTTPBadRequest(
+            'Invalid model',
+            '"model" must be one of ' + ', '.join(MODELS + (MODEL_ENSEMBLE,))
+            + '.')
+    return model
+
+
+def parse_list(req, name):
+    """
+    Values of a repeated and/or comma separated parameter, e.g. lang=de,en;
+    falcon 3 no longer splits on commas by default.
+    """
+    values = req.get_param_as_list(name)
+    if values is None:
+        return None
+    return [item for value in values for item in value.split(',') if item]
+
+
+def parse_question(doc):
+    if not isinstance(doc, dict):
+        raise falcon.HTTPBadRequest(
+            'Invalid question',
+            'Each question must be a JSON object.')
+
+    def as_list(name):
+        value = doc.get(name)
+        if isinstance(value, str):
+            value = value.split(',')
+        if value is not None and not isinstance(value, list):
+            raise falcon.HTTPBadRequest(
+                'Invalid question',
+                f'"{name}" must be a list or a comma separated string.')
+        return value
+
+    def as_int(name):
+        value = doc.get(name)
+        if value is not None and type(value) is not int:
+            raise falcon.HTTPBadRequest(
+                'Invalid question', f'"{name}" must be an integer.')
+        return value
+
+    query = doc.get('q') or ''
+    if not isinstance(query, str):
+        raise falcon.HTTPBadRequest(
+            'Invalid question', '"q" must be a string.')
+    filters = {
+        'lang': as_list('lang'),
+        'theme': as_list('theme'),
+        'sub_theme': as_list('sub_theme'),
+        'year_min': as_int('year_min'),
+        'year_max': as_int('year_max'),
+    }
+    mode = doc.get('mode')
+    if mode is not None and not isinstance(mode, str):
+        raise falcon.HTTPBadRequest(
+            'Invalid question', '"mode" must be a string.')
+    model = doc.get('model')
+    if model is not None and not isinstance(model, str):
+        raise falcon.HTTPBadRequest(
+            'Invalid question', '"model" must be a string.')
+    offset, limit = parse_offset(as_int('offset'), parse_limit(as_int('limit')))
+    return query, filters, limit, parse_mode(mode), offset, parse_model(model)
+
+
+def parse_questions(req):
+    try:
+        doc = req.context.doc
+    except AttributeError:
+        raise falcon.HTTPBadRequest(
+            'Missing questions',
+            'A JSON array of questions must be submitted in the request body.')
+    if not isinstance(doc, list) or not doc:
+        raise falcon.HTTPBadRequest(
+            'Missing questions',
+            'A JSON array of questions must be submitted in the request body.')
+    if len(doc) > BATCH_LIMIT:
+        raise falcon.HTTPBadRequest(
+            'Too many questions',
+            f'A batch must not exceed {BATCH_LIMIT} questions.')
+    return [parse_question(item) for item in doc]
+
+
 class PapersResource(object):
 
     def __init__(self, db):
@@ -374,22 +1300,30 @@ class PapersResource(object):
 
     def on_get(self, req, resp):
         query = req.get_param('q') or ''
-        limit = req.get_param_as_int('limit') or RETURN_DEFAULT
-        if limit > RETURN_LIMIT:
-            limit = RETURN_LIMIT
+        limit = parse_limit(req.get_param_as_int('limit'))
 
-        # TODO: implement filters
         filters = {
-            # 'lang': lambda lang: lang == 'en'
+            'lang': parse_list(req, 'lang'),
+            'theme': parse_list(req, 'theme'),
+            'sub_theme': parse_list(req, 'sub_theme'),
+            'year_min': req.get_param_as_int('year_min'),
+            'year_max': req.get_param_as_int('year_max'),
         }
+        mode = parse_mode(req.get_param('mode'))
+        offset, limit = parse_offset(req.get_param_as_int('offset'), limit)
+        model = parse_model(req.get_param('model'))
 
         try:
+            results = self.db.ask_question(query, filters, limit, mode, offset,
+                                           model)
+            metrics.add_timings(results.timings)
             result = {
                 'query': query,
-                ** self.db.format_results(
-                    self.db.ask_question(query, filters, limit)
-                ),
+                ** page_info(offset, limit, results),
+                ** self.db.format_results(results),
             }
+        except AnswerError:
+            raise
         except Exception as ex:
             self.logger.error(ex)
 
@@ -417,19 +1351,190 @@ class PapersResource(object):
         resp.status = falcon.HTTP_200
 
 
+class CacheStatsResource(object):
+
+    def __init__(self, db):
+        self.db = db
+
+    def on_get(self, req, resp):
+        resp.context.result = self.db.cache_stats()
+        resp.set_header('Powered-By', 'Papers')
+        resp.status = falcon.HTTP_200
+
+
+class MetricsResource(object):
+    """
+    Prometheus text exposition of the metrics of this process.
+    """
+
+    def on_get(self, req, resp):
+        resp.body = metrics.render()
+        resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        resp.status = falcon.HTTP_200
+
+
+class ProfileResource(object):
+    """
+    The sampling profiler: GET the stacks collected so far in collapsed
+    format (for flamegraph.pl or speedscope), POST {"enabled": true,
+    "interval_ms": 5} to start it and {"enabled": false} to stop it.
+    """
+
+    def on_get(self, req, resp):
+        resp.body = metrics.profiler.report()
+        resp.content_type = 'text/plain; charset=utf-8'
+        resp.set_header('Profile-Samples', str(metrics.profiler.samples))
+        resp.status = falcon.HTTP_200
+
+    def on_post(self, req, resp):
+        doc = getattr(req.context, 'doc', None)
+        if not isinstance(doc, dict) or not isinstance(doc.get('enabled'), bool):
+            raise falcon.HTTPBadRequest(
+                'Invalid profiler settings',
+                'A JSON object with a boolean "enabled" is required.')
+        interval = doc.get('interval_ms', metrics.PROFILE_INTERVAL * 1000)
+        if not isinstance(interval, (int, float)) or not 1 <= interval <= 1000:
+            raise falcon.HTTPBadRequest(
+                'Invalid profiler interval',
+                '"interval_ms" must be between 1 and 1000.')
+        if doc['enabled']:
+            metrics.profiler.start(interval / 1000)
+        else:
+            metrics.profiler.stop()
+        resp.context.result = {
+            'enabled': metrics.profiler.enabled,
+            'interval_ms': metrics.profiler.interval * 1000,
+            'samples': metrics.profiler.samples,
+        }
+        resp.status = falcon.HTTP_200
+
+
+class ReloadResource(object):
+    """
+    POST switches to the current data (e.g. after `python ingest.py`), like
+    SIGHUP to `python papers.py`, for servers that import `app` (gunicorn,
+    uvicorn with papers_async). With several worker processes only the one
+    answering the request reloads.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def on_post(self, req, resp):
+        self.db.check_ready()
+        if not self.db.reload():
+            raise AnswerError('Reload failed, the previous data stays in use.')
+        resp.context.result = {'reloaded': True}
+        resp.status = falcon.HTTP_200
+
+
+def register_metrics(db):
+    """
+    Gauges and counters read from the engine at scrape time.
+    """
+    def cache_values(field):
+        return lambda: {(name,): stats[field]
+                        for name, stats in db.cache_stats().items()}
+
+    for field, kind in (('hits', 'counter'), ('misses', 'counter'),
+                        ('evictions', 'counter')):
+        metrics.Callback(f'papers_cache_{field}_total', f'Cache {field}.',
+                         cache_values(field), ('cache',), kind)
+    for field in ('bytes', 'entries'):
+        metrics.Callback(f'papers_cache_{field}', f'Cache {field} held.',
+                         cache_values(field), ('cache',))
+    metrics.Callback('papers_data_bytes',
+                     'Bytes of the model and the loaded data, by part.',
+                     lambda: {(part, ): size
+                              for part, size in db.memory().items()},
+                     ('part',))
+    metrics.Callback('papers_ready', 'Whether the engine answers questions.',
+                     lambda: {(): int(db.ready.is_set())})
+
+
+class PapersBatchResource(object):
+    """
+    POST a JSON array of questions, answered in one batched pass:
+
+        [{"q": "whats corona", "limit": 10, "lang": ["en"]},
+         {"q": "incubation period", "year_min": 2020},
+         {"q": "tmprss2", "mode": "lexical", "offset": 20},
+         {"q": "ace2 receptor", "model": "ensemble"}]
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.logger = logging.getLogger('papersapp.' + __name__)
+
+    @falcon.before(max_body(BATCH_BODY_LIMIT))
+    def on_post(self, req, resp):
+        questions = parse_questions(req)
+
+        try:
+            answers = self.db.ask_questions(questions)
+            # one batch, the timings are shared by all answers
+            metrics.add_timings(answers[0].timings if answers else ())
+            result = [
+                {
+                    'query': query,
+                    ** page_info(offset, limit, answer),
+                    ** self.db.format_results(answer),
+                }
+                for (query, _, limit, _, offset, _), answer
+                in zip(questions, answers)
+            ]
+        except AnswerError:
+            raise
+        except Exception as ex:
+            self.logger.error(ex)
+
+            description = ('Aliens have attacked our base! We will '
+                           'be back as soon as we fight them off. '
+                           'We appreciate your patience.')
+
+            raise falcon.HTTPServiceUnavailable(
+                'Service Outage',
+                description,
+                30)
+
+        resp.context.result = result
+
+        resp.set_header('Access-Control-Allow-Origin', '*')
+        resp.set_header('Powered-By', 'Papers')
+        resp.status = falcon.HTTP_200
+
+
+db = AnswerEngine(CORPUS_PATH, MODEL_PATH, EMBEDDINGS_PATH, INDEX_PATH,
+                  models={name: model_paths(name) for name in MODELS},
+                  reranker_path=RERANK_PATH)
+
 # Configure your WSGI server to load "things.app" (app is a WSGI callable)
 app = falcon.API(middleware=[
+    MetricsMiddleware(),
+    StartupMiddleware(db),
+    CompressionMiddleware(),
     CORSComponent(),
     AuthMiddleware(),
     RequireJSON(),
     JSONTranslator(),
 ])
 
-db = AnswerEngine(CORPUS_PATH, MODEL_PATH, EMBEDDINGS_PATH)
+if MICRO_BATCH_SIZE > 1:
+    db = batching.MicroBatcher(db, MICRO_BATCH_SIZE, MICRO_BATCH_WAIT,
+                               RETURN_DEFAULT)
 papers = PapersResource(db)
 app.add_route('/papers', papers)
+papers_batch = PapersBatchResource(db)
+app.add_route('/papers/batch', papers_batch)
+cache_stats = CacheStatsResource(db)
+app.add_route('/papers/cache', cache_stats)
+app.add_route('/reload', ReloadResource(db))
+register_metrics(db)
+app.add_route('/metrics', MetricsResource())
+app.add_route('/metrics/profile', ProfileResource())
 app.add_error_handler(AnswerError, AnswerError.handle)
-health = HealthSink()
+app.add_error_handler(NotReadyError, NotReadyError.handle)
+health = HealthSink(db)
 app.add_sink(health, r'/health(?:/.*)?\Z')
 
 # db = StorageEngine()
@@ -451,7 +1556,50 @@ app.add_sink(health, r'/health(?:/.*)?\Z')
 # auto-restart workers when it detects a code change, and it also works
 # with pdb.
 
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, simple_server.WSGIServer):
+    # one thread per request, so concurrent questions can be micro-batched
+    daemon_threads = True
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="Number of pre-forked worker processes sharing the loaded "
+             "model, corpus and embeddings."
+    )
+    parser.add_argument(
+        "--threads",
+        default=None,
+        type=int,
+        help="Torch intra-op threads per worker (default: CPUs / workers)."
+    )
+    parser.add_argument(
+        "--pin_cpus",
+        action="store_true",
+        help="Pin every worker to its own share of the CPUs."
+    )
+    args = parser.parse_args()
+
+    # `kill -HUP <pid>` after `python ingest.py` switches to the new data
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+        target=db.reload, name='reload', daemon=True).start())
+
+    if args.workers > 1:
+        # workers share what the parent loaded, so load before forking; the
+        # model first runs in the workers, after fork (see prefork.serve)
+        db.start(warmup=())
+    else:
+        db.start()
     print(f'Serving at {HOST}:{PORT}')
-    httpd = simple_server.make_server(HOST, PORT, app)
-    httpd.serve_forever()
+    httpd = simple_server.make_server(HOST, PORT, app,
+                                      server_class=ThreadingWSGIServer)
+    if args.workers > 1:
+        if not db.wait():
+            raise SystemExit(1)
+        prefork.serve(httpd, args.workers, args.threads, args.pin_cpus,
+                      lambda: db.warmup(WARMUP_QUERIES))
+    else:
+        httpd.serve_forever()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+# ASGI variant of papers.py, run with e.g.
+#
+#   uvicorn papers_async:app --host 0.0.0.0 --port 8000
+#
+# Model encoding and scoring run in a bounded thread pool, so health checks
+# and slow clients never wait behind an inference.
+
+import asyncio
+import contextvars
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import falcon
+import falcon.asgi
+
+import batching
+import metrics
+import papers
+from papers import (db, AnswerError, AuthMiddleware, CompressionMiddleware,
+                    CORSComponent, JSONTranslator, MetricsMiddleware,
+                    NotReadyError, RequireJSON, StartupMiddleware,
+                    BATCH_BODY_LIMIT, MICRO_BATCH_SIZE, page_info, parse_limit,
+                    parse_list, parse_mode, parse_model, parse_offset,
+                    parse_questions)
+
+# threads running inference, with micro-batching enabled they mostly wait
+# for the batcher so there should be at least one per batch slot
+INFERENCE_WORKERS = max(MICRO_BATCH_SIZE, 4)
+# questions waiting for or in inference before new ones are rejected
+INFERENCE_QUEUE_LIMIT = 4 * INFERENCE_WORKERS
+# seconds a question may take before the request fails
+INFERENCE_TIMEOUT = 30
+RETRY_AFTER = 5
+# status logged for a request whose client disconnected (nginx's)
+CLIENT_CLOSED_REQUEST = '499 Client Closed Request'
+
+
+class InferenceQueue(object):
+    """
+    Runs blocking engine calls off the event loop with back-pressure: when
+    INFERENCE_QUEUE_LIMIT calls are pending new ones get 503 + Retry-After.
+    A call whose request timed out or whose client disconnected is dropped
+    from the executor queue if it has not started yet, and its questions
+    still waiting for the micro-batcher are skipped; one already running
+    can't be stopped and counts as pending until it finishes, so the limit
+    bounds all the work in flight.
+    """
+
+    def __init__(self, workers=INFERENCE_WORKERS, limit=INFERENCE_QUEUE_LIMIT,
+                 timeout=INFERENCE_TIMEOUT):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='inference')
+        self.limit = limit
+        self.timeout = timeout
+        self.pending = 0
+        # done callbacks run in the executor threads
+        self.lock = threading.Lock()
+
+    def _done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    @staticmethod
+    async def _disconnected(req):
+        # JSONTranslator has read the body, all that is left to receive is
+        # the http.disconnect of a client that went away
+        while (await req._receive())['type'] != 'http.disconnect':
+            pass
+
+    async def run(self, fn, *args, req=None):
+        with self.lock:
+            if self.pending >= self.limit:
+                raise falcon.HTTPServiceUnavailable(
+                    title='Overloaded',
+                    description='Too many questions in flight, please retry.',
+                    retry_after=RETRY_AFTER)
+            self.pending += 1
+        # in the request's context, so the stages timed count for it
+        with batching.tracking() as submitted:
+            future = self.executor.submit(contextvars.copy_context().run,
+                                          fn, *args)
+        future.add_done_callback(self._done)
+        answer = asyncio.wrap_future(future)
+        waiting = [answer]
+        if req is not None:
+            waiting.append(asyncio.ensure_future(self._disconnected(req)))
+        try:
+            done, _ = await asyncio.wait(waiting, timeout=self.timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if answer in done:
+                return answer.result()
+            if not done:
+                raise falcon.HTTPError(falcon.HTTP_504,
+                                       'Answer Timeout',
+                                       'The question took too long to answer.')
+            # nobody is left to read the response
+            raise falcon.HTTPError(CLIENT_CLOSED_REQUEST,
+                                   'Client Closed Request')
+        finally:
+            for waiter in waiting:
+                waiter.cancel()
+            # only succeeds while the call waits in the executor queue, or
+            # its questions wait for the micro-batcher
+            future.cancel()
+            for question in submitted:
+                question.cancel()
+
+
+def max_body(limit):
+
+    async def hook(req, resp, resource, params):
+        length = req.content_length
+        if length is not None and length > limit:
+            msg = ('The size of the request is too large. The body must not '
+                   'exceed ' + str(limit) + ' bytes in length.')
+
+            raise falcon.HTTPPayloadTooLarge(
+                'Request body is too large', msg)
+
+    return hook
+
+
+def service_outage():
+    description = ('Aliens have attacked our base! We will '
+                   'be back as soon as we fight them off. '
+                   'We appreciate your patience.')
+
+    return falcon.HTTPServiceUnavailable(
+        title='Service Outage',
+        description=description,
+        retry_after=30)
+
+
+class HealthSink(papers.HealthSink):
+
+    async def __call__(self, req, resp, **kwargs):
+        super().__call__(req, resp, **kwargs)
+
+
+class CacheStatsResource(object):
+
+    def __init__(self, db):
+        self.db = db
+
+    async def on_get(self, req, resp):
+        resp.context.result = self.db.cache_stats()
+        resp.set_header('Powered-By', 'Papers')
+        resp.status = falcon.HTTP_200
+
+
+class MetricsResource(papers.MetricsResource):
+
+    async def on_get(self, req, resp):
+        super().on_get(req, resp)
+
+
+class ProfileResource(papers.ProfileResource):
+
+    async def on_get(self, req, resp):
+        super().on_get(req, resp)
+
+    async def on_post(self, req, resp):
+        super().on_post(req, resp)
+
+
+class ReloadResource(papers.ReloadResource):
+
+    async def on_post(self, req, resp):
+        # loading the new data takes a while, keep the event loop free
+        await asyncio.get_running_loop().run_in_executor(
+            None, super().on_post, req, resp)
+
+
+class PapersResource(object):
+
+    def __init__(self, db, inference):
+        self.db = db
+        self.inference = inference
+        self.logger = logging.getLogger('papersapp.' + __name__)
+
+    def answer(self, query, filters, limit, mode, offset, model):
+        results = self.db.ask_question(query, filters, limit, mode, offset,
+                                       model)
+        metrics.add_timings(results.timings)
+        return {
+            'query': query,
+            ** page_info(offset, limit, results),
+            ** self.db.format_results(results),
+        }
+
+    async def on_get(self, req, resp):
+        query = req.get_param('q') or ''
+        limit = parse_limit(req.get_param_as_int('limit'))
+
+        filters = {
+            'lang': parse_list(req, 'lang'),
+            'theme': parse_list(req, 'theme'),
+            'sub_theme': parse_list(req, 'sub_theme'),
+            'year_min': req.get_param_as_int('year_min'),
+            'year_max': req.get_param_as_int('year_max'),
+        }
+        mode = parse_mode(req.get_param('mode'))
+        offset, limit = parse_offset(req.get_param_as_int('offset'), limit)
+        model = parse_model(req.get_param('model'))
+
+        try:
+            result = await self.inference.run(self.answer, query, filters, limit,
+                                              mode, offset, model, req=req)
+        except (falcon.HTTPError, AnswerError):
+            raise
+        except Exception as ex:
+            self.logger.error(ex)
+            raise service_outage()
+
+        resp.context.result = result
+
+        resp.set_header('Access-Control-Allow-Origin', '*')
+        resp.set_header('Powered-By', 'Papers')
+        resp.status = falcon.HTTP_200
+
+
+class PapersBatchResource(object):
+
+    def __init__(self, db, inference):
+        self.db = db
+        self.inference = inference
+        self.logger = logging.getLogger('papersapp.' + __name__)
+
+    def answer(self, questions):
+        answers = self.db.ask_questions(questions)
+        metrics.add_timings(answers[0].timings if answers else ())
+        return [
+            {
+                'query': query,
+                ** page_info(offset, limit, answer),
+                ** self.db.format_results(answer),
+            }
+            for (query, _, limit, _, offset, _), answer
+            in zip(questions, answers)
+        ]
+
+    @falcon.before(max_body(BATCH_BODY_LIMIT))
+    async def on_post(self, req, resp):
+        questions = parse_questions(req)
+
+        try:
+            result = await self.inference.run(self.answer, questions, req=req)
+        except (falcon.HTTPError, AnswerError):
+            raise
+        except Exception as ex:
+            self.logger.error(ex)
+            raise service_outage()
+
+        resp.context.result = result
+
+        resp.set_header('Access-Control-Allow-Origin', '*')
+        resp.set_header('Powered-By', 'Papers')
+        resp.status = falcon.HTTP_200
+
+
+app = falcon.asgi.App(middleware=[
+    MetricsMiddleware(),
+    StartupMiddleware(db),
+    CompressionMiddleware(),
+    CORSComponent(),
+    AuthMiddleware(),
+    RequireJSON(),
+    JSONTranslator(),
+])
+
+inference = InferenceQueue()
+papers = PapersResource(db, inference)
+app.add_route('/papers', papers)
+papers_batch = PapersBatchResource(db, inference)
+app.add_route('/papers/batch', papers_batch)
+cache_stats = CacheStatsResource(db)
+app.add_route('/papers/cache', cache_stats)
+app.add_route('/reload', ReloadResource(db))
+app.add_route('/metrics', MetricsResource())
+app.add_route('/metrics/profile', ProfileResource())
+app.add_error_handler(AnswerError, AnswerError.handle_async)
+app.add_error_handler(NotReadyError, NotReadyError.handle_async)
+health = HealthSink(db)
+app.add_sink(health, r'/health(?:/.*)?\Z')
@@ -0,0 +1,250 @@
+import argparse
+import os
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+import corpus
+import embeddings
+import search
+
+DATA_PATH = 'data'
+MODELS_PATH = 'models'
+CORPUS_PATH = os.path.join(DATA_PATH, 'corpus.pkl')
+
+# abstract windows of PASSAGE_WORDS words, PASSAGE_STRIDE apart; 80 words
+# stay within the 128 tokens the models read
+PASSAGE_WORDS = 80
+PASSAGE_STRIDE = 40
+# passages of a paper (title included), bounds the store to a few times
+# the number of papers
+MAX_PASSAGES = 16
+# float16 halves the store, scores are upcast block by block
+DTYPE = 'float16'
+# passages encoded at once, bounds the float32 model output held in memory
+ENCODE_CHUNK = 16384
+# paper score from its passage scores: 'max', or 'top_m' for the mean of
+# the TOP_M best
+POOLING = 'max'
+POOLINGS = ('max', 'top_m')
+TOP_M = 2
+
+
+def store_paths(embeds_path):
+    """
+    data/scibert-nli-embeddings.pkl -> data/scibert-nli-embeddings-passages.npy
+    (vectors) and data/scibert-nli-embeddings-passages.npz (passage -> row)
+    """
+    base = os.path.splitext(embeds_path)[0] + '-passages'
+    return base + '.npy', base + '.npz'
+
+
+def exists(embeds_path):
+    return all(os.path.exists(path) for path in store_paths(embeds_path))
+
+
+def split(title, abstract, words=PASSAGE_WORDS, stride=PASSAGE_STRIDE,
+          limit=MAX_PASSAGES):
+    """
+    The title and overlapping windows of the abstract, the last window
+    ending with it. A paper always has one passage at least.
+    """
+    passages = [title.strip()] if title and title.strip() else []
+    tokens = (abstract or '').split()
+    if tokens:
+        starts = list(range(0, max(len(tokens) - words, 0) + 1, stride))
+        if starts[-1] + words < len(tokens):
+            starts.append(len(tokens) - words)
+        passages.extend(' '.join(tokens[start:start + words])
+                        for start in starts)
+    return passages[:limit] or ['']
+
+
+class PassageStore(object):
+    """
+    Passage embeddings, grouped by paper in row order: the passages of row
+    i are offsets[i]:offsets[i + 1].
+    """
+
+    def __init__(self, embeds, rows, words, stride, size=None):
+        self.embeds = embeds
+        self.rows = rows
+        self.words = words
+        self.stride = stride
+        size = int(rows[-1]) + 1 if size is None and len(rows) else size or 0
+        self.offsets = np.searchsorted(rows, np.arange(size + 1))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def load(cls, embeds_path):
+        npy_path, map_path = store_paths(embeds_path)
+        data = np.load(map_path)
+        return cls(embeddings.load(npy_path), data['rows'],
+                   int(data['words']), int(data['stride']))
+
+    def save(self, embeds_path, dtype=DTYPE):
+        npy_path, map_path = store_paths(embeds_path)
+        embeddings.save(npy_path, self.embeds, dtype)
+        tmp_path = map_path + '.tmp.npz'
+        np.savez(tmp_path, rows=self.rows, words=self.words, stride=self.stride)
+        os.replace(tmp_path, map_path)
+
+    def nbytes(self):
+        return self.embeds.nbytes + self.rows.nbytes
+
+
+def build(store, model_path, old=None, reuse=None, words=PASSAGE_WORDS,
+          stride=PASSAGE_STRIDE, dtype=DTYPE):
+    """
+    Passages of every paper of the corpus store. Papers with an old row in
+    `reuse` (see ingest.diff) copy their passages from the `old` store, if
+    it was split the same way; only the others go through the model.
+    """
+    if old is None or reuse is None or (old.words, old.stride) != (words, stride):
+        reuse = np.full(len(store), -1, dtype=np.int64)
+    counts = np.empty(len(store), dtype=np.int64)
+    texts = []
+    for idx, old_idx in enumerate(reuse.tolist()):
+        if old_idx >= 0:
+            counts[idx] = old.offsets[old_idx + 1] - old.offsets[old_idx]
+        else:
+            chunks = split(store.get('title', idx), store.get('abstract', idx),
+                           words, stride)
+            counts[idx] = len(chunks)
+            texts.extend(chunks)
+    rows = np.repeat(np.arange(len(store), dtype=np.int32), counts)
+    print(f'{len(rows)} passages of {len(store)} papers, '
+          f'encoding {len(texts)}')
+
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def positions(papers, papers_offsets):
+        # passage positions of the given papers, in paper order
+        sizes = counts[papers]
+        run = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        return np.repeat(papers_offsets, sizes) + run
+
+    embeds = None
+    if texts:
+        model = SentenceTransformer(model_path)
+        encoded = np.flatnonzero(reuse < 0)
+        encoded_at = positions(encoded, offsets[encoded])
+        # chunk by chunk, a float32 copy of every passage would not fit
+        for start in range(0, len(texts), ENCODE_CHUNK):
+            encoded = search.normalize(model.encode(
+                texts[start:start + ENCODE_CHUNK], show_progress_bar=False))
+            if embeds is None:
+                dim = encoded.shape[1]
+                if (old is not None and (reuse >= 0).any()
+                        and dim != old.embeds.shape[1]):
+                    raise ValueError('The model changed, run a full ingest.')
+                embeds = np.empty((len(rows), dim), dtype=dtype)
+            embeds[encoded_at[start:start + len(encoded)]] = encoded
+            print(f'Encoded {start + len(encoded)}/{len(texts)} passages')
+    else:
+        embeds = np.empty((len(rows), old.embeds.shape[1]), dtype=dtype)
+    copied = np.flatnonzero(reuse >= 0)
+    if len(copied):
+        embeds[positions(copied, offsets[copied])] = \
+            old.embeds[positions(copied, old.offsets[reuse[copied]])]
+    return PassageStore(embeds, rows, words, stride, len(store))
+
+
+class PassageIndex(object):
+    """
+    Paper level search over passage embeddings: passages are scored like
+    rows of the exact scan and every paper gets the max (or the mean of the
+    top_m best) of its passage scores, pooled with array operations over
+    all papers at once.
+    """
+
+    def __init__(self, store, pooling=POOLING, top_m=TOP_M):
+        if pooling not in POOLINGS:
+            raise ValueError(f'pooling should be one of {", ".join(POOLINGS)}')
+        self.store = store
+        self.pooling = pooling
+        self.counts = np.diff(store.offsets)
+        self.top_m = min(top_m, int(self.counts.max()) if len(self.counts) else 1)
+        # position of every passage within its paper
+        self.slots = np.arange(len(store.rows)) - store.offsets[store.rows]
+
+    def passages(self, rows):
+        """
+        Passage ids of the papers `rows`, paper after paper, and where the
+        passages of each start in them.
+        """
+        counts = self.counts[rows]
+        starts = np.cumsum(counts) - counts
+        ids = np.repeat(self.store.offsets[rows] - starts, counts) \
+            + np.arange(counts.sum())
+        return ids, starts
+
+    def pool(self, scores, starts, counts, slots):
+        if self.pooling == 'max' or self.top_m == 1:
+            return np.maximum.reduceat(scores, starts)
+        # papers x passages, -inf past their last passage
+        width = int(counts.max())
+        top_m = min(self.top_m, width)
+        padded = np.full((len(counts), width), -np.inf, dtype=np.float32)
+        padded[np.repeat(np.arange(len(counts)), counts), slots] = scores
+        best = np.partition(padded, width - top_m, axis=1)[:, width - top_m:]
+        best[np.isneginf(best)] = 0
+        return best.sum(axis=1) / np.minimum(counts, top_m)
+
+    def similarity(self, query_embed, rows):
+        """
+        Pooled scores of the papers `rows`, only their passages scored.
+        """
+        ids, starts = self.passages(rows)
+        scores = search.similarity(self.store.embeds[ids], query_embed)
+        return self.pool(scores, starts, self.counts[rows], self.slots[ids])
+
+    def scores(self, query_embed, passage_scores=None):
+        if passage_scores is None:
+            passage_scores = search.similarity(self.store.embeds, query_embed)
+        return self.pool(passage_scores, self.store.offsets[:-1], self.counts,
+                         self.slots)
+
+    def iter_search(self, query_embed, k, mask=None, passage_scores=None):
+        if mask is not None:
+            rows = np.flatnonzero(mask)
+            if len(rows) == 0:
+                return
+            if passage_scores is None and \
+                    len(rows) < len(self.counts) * search.SPARSE_MASK:
+                scores = self.similarity(query_embed, rows)
+                for i in search.iter_top_k(scores, k):
+                    yield int(rows[i]), float(scores[i])
+                return
+        yield from search.iter_search(None, query_embed, k, mask,
+                                      self.scores(query_embed, passage_scores))
+
+    def iter_search_batch(self, query_embeds, ks, masks):
+        # one matrix-matrix product scores the passages for every query
+        scores = search.similarity_batch(self.store.embeds, query_embeds)
+        return [
+            self.iter_search(query_embed, k, mask, query_scores)
+            for query_embed, k, mask, query_scores
+            in zip(query_embeds, ks, masks, scores)
+        ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Split titles and abstracts into overlapping passages and '
+                    'embed them, for passage level search.')
+    parser.add_argument('--model', default='scibert-nli', type=str)
+    parser.add_argument('--corpus', default=CORPUS_PATH, type=str)
+    parser.add_argument('--words', default=PASSAGE_WORDS, type=int)
+    parser.add_argument('--stride', default=PASSAGE_STRIDE, type=int)
+    parser.add_argument('--dtype', default=DTYPE, choices=embeddings.DTYPES)
+    args = parser.parse_args()
+
+    embeds_path = os.path.join(DATA_PATH, f'{args.model}-embeddings.pkl')
+    store = build(corpus.load(args.corpus),
+                  os.path.join(MODELS_PATH, args.model),
+                  words=args.words, stride=args.stride, dtype=args.dtype)
+    store.save(embeds_path, args.dtype)
+    print('Passages available in', ', '.join(store_paths(embeds_path)))
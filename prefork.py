@@ -0,0 +1,107 @@
+import gc
+import os
+import signal
+import time
+
+# seconds to wait before replacing a worker that died
+RESPAWN_DELAY = 1
+
+
+def worker_cpus(slot, workers):
+    """
+    Disjoint share of the CPUs available to the parent for worker `slot`.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    per_worker = max(1, len(cpus) // workers)
+    start = (slot * per_worker) % len(cpus)
+    return cpus[start:start + per_worker]
+
+
+def setup_worker(slot, workers, threads=None, pin_cpus=False):
+    if pin_cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, worker_cpus(slot, workers))
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+    # workers share the node, so each one only gets its slice of intra-op threads
+    import torch
+    torch.set_num_threads(threads)
+
+
+def serve(httpd, workers, threads=None, pin_cpus=False, warmup=None):
+    """
+    Pre-fork server: everything loaded before the call (model, corpus,
+    embeddings) lives in the parent and is shared with the forked workers.
+    The parent should only have loaded tensors, not run the model: torch's
+    thread pools don't survive fork(), so warmup() runs in every worker once
+    its threads are set, before it accepts connections.
+    Memory-mapped stores are shared through the page cache, heap arrays
+    copy-on-write as nothing writes to them after loading. Every worker
+    accepts connections on the parent's listening socket; dead workers are
+    replaced until the parent gets SIGINT/SIGTERM. SIGHUP is forwarded to
+    the workers and also handled by the parent, so replacement workers start
+    from up to date data.
+    """
+    # keep the garbage collector from touching (and so copying) the pages
+    # of objects loaded by the parent
+    gc.freeze()
+    children = {}
+    stopping = False
+    on_hup = signal.getsignal(signal.SIGHUP)
+
+    def spawn(slot):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, on_hup)
+            code = 0
+            try:
+                setup_worker(slot, workers, threads, pin_cpus)
+                if warmup is not None:
+                    warmup()
+                print(f'Worker {slot} serving (pid {os.getpid()})')
+                httpd.serve_forever()
+            except BaseException as ex:
+                print(f'Worker {slot} failed: {ex}')
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = slot
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def hup(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+        if callable(on_hup):
+            on_hup(signum, frame)
+
+    for slot in range(workers):
+        spawn(slot)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, hup)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot = children.pop(pid, None)
+        if slot is None or stopping:
+            continue
+        print(f'Worker {slot} exited with status {status}, restarting...')
+        time.sleep(RESPAWN_DELAY)
+        if not stopping:
+            spawn(slot)
+    httpd.server_close()
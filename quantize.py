@@ -0,0 +1,283 @@
+import argparse
+import itertools
+import os
+
+import numpy as np
+
+import ann
+import embeddings
+import search
+
+DATA_PATH = 'data'
+
+MODES = ('float16', 'int8', 'pq')
+# approximate candidates re-ranked with the exact vectors per requested row
+RERANK_FACTOR = 4
+# rows scored at once, bounds the temporaries of the code lookups
+CODE_BATCH = 16384
+# dimensions per product quantization sub-vector, 4 -> 16x smaller than float32
+PQ_SUBSPACE_DIM = 4
+PQ_CENTROIDS = 256
+PQ_ITER = 15
+PQ_SAMPLE = 50000
+
+
+def codes_path(embeds_path, mode):
+    """
+    data/scibert-nli-embeddings.pkl -> data/scibert-nli-int8.npz
+    """
+    base = os.path.splitext(embeds_path)[0]
+    if base.endswith('-embeddings'):
+        base = base[:-len('-embeddings')]
+    return f'{base}-{mode}.npz'
+
+
+def _blocks(size, rows=None):
+    for start in range(0, size if rows is None else len(rows), CODE_BATCH):
+        stop = start + CODE_BATCH
+        yield start, (slice(start, stop) if rows is None else rows[start:stop])
+
+
+class Float16Codes(object):
+    mode = 'float16'
+
+    def __init__(self, codes):
+        self.codes = codes
+
+    @classmethod
+    def train(cls, embeds):
+        codes = np.empty(embeds.shape, dtype=np.float16)
+        for start, block in _blocks(len(embeds)):
+            codes[block] = embeds[block]
+        return cls(codes)
+
+    def similarity(self, query_embed, rows=None):
+        codes = self.codes if rows is None else self.codes[rows]
+        return search.similarity(codes, query_embed)
+
+    def arrays(self):
+        return {'codes': self.codes}
+
+
+class Int8Codes(object):
+    """
+    Every dimension scaled to [-127, 127] by its largest absolute value.
+    """
+    mode = 'int8'
+
+    def __init__(self, codes, scale):
+        self.codes = codes
+        self.scale = scale
+
+    @classmethod
+    def train(cls, embeds):
+        scale = np.zeros(embeds.shape[1], dtype=np.float32)
+        for start, block in _blocks(len(embeds)):
+            np.maximum(scale, np.abs(embeds[block]).max(axis=0), out=scale)
+        scale = np.where(scale > 0, scale / 127, 1).astype(np.float32)
+        codes = np.empty(embeds.shape, dtype=np.int8)
+        for start, block in _blocks(len(embeds)):
+            codes[block] = np.clip(np.rint(embeds[block] / scale), -127, 127)
+        return cls(codes, scale)
+
+    def similarity(self, query_embed, rows=None):
+        query = query_embed * self.scale
+        size = len(self.codes) if rows is None else len(rows)
+        scores = np.empty(size, dtype=np.float32)
+        for start, block in _blocks(len(self.codes), rows):
+            codes = self.codes[block].astype(np.float32)
+            scores[start:start + len(codes)] = codes @ query
+        return scores
+
+    def arrays(self):
+        return {'codes': self.codes, 'scale': self.scale}
+
+
+def kmeans(data, k, n_iter, rng):
+    """
+    Plain euclidean k-means, used for the product quantization codebooks.
+    """
+    centroids = data[rng.choice(len(data), k, replace=len(data) < k)].copy()
+    for _ in range(n_iter):
+        assign = _nearest(data, centroids)
+        sums, counts = ann.cluster_sums(data, assign, k)
+        empty = counts == 0
+        centroids = sums / np.maximum(counts, 1)[:, None]
+        # re-seed empty clusters with random rows
+        centroids[empty] = data[rng.choice(len(data), empty.sum())]
+    return centroids.astype(np.float32)
+
+
+def _nearest(data, centroids):
+    distances = (centroids ** 2).sum(axis=1) - 2 * data @ centroids.T
+    return np.argmin(distances, axis=1)
+
+
+class PQCodes(object):
+    """
+    Product quantization: vectors are split into sub-vectors of
+    PQ_SUBSPACE_DIM dimensions, each stored as the uint8 id of its nearest
+    codebook entry. A query is scored with one lookup table per sub-space.
+    """
+    mode = 'pq'
+
+    def __init__(self, codes, codebooks):
+        self.codes = codes
+        self.codebooks = codebooks
+
+    @classmethod
+    def train(cls, embeds, subspace_dim=PQ_SUBSPACE_DIM, n_iter=PQ_ITER,
+              sample=PQ_SAMPLE, seed=0):
+        size, dim = embeds.shape
+        if dim % subspace_dim:
+            raise ValueError(f'{dim} dimensions can\'t be split into '
+                             f'sub-vectors of {subspace_dim}.')
+        rng = np.random.default_rng(seed)
+        m = dim // subspace_dim
+        rows = np.sort(rng.choice(size, min(size, sample), replace=False))
+        train = np.asarray(embeds[rows], dtype=np.float32) \
+            .reshape(-1, m, subspace_dim)
+        codebooks = np.stack([
+            kmeans(train[:, i], PQ_CENTROIDS, n_iter, rng) for i in range(m)
+        ])
+        codes = np.empty((size, m), dtype=np.uint8)
+        for start, block in _blocks(size):
+            vectors = np.asarray(embeds[block], dtype=np.float32) \
+                .reshape(-1, m, subspace_dim)
+            for i in range(m):
+                codes[block, i] = _nearest(vectors[:, i], codebooks[i])
+        return cls(codes, codebooks)
+
+    def similarity(self, query_embed, rows=None):
+        m, _, subspace_dim = self.codebooks.shape
+        query = query_embed.reshape(m, subspace_dim)
+        # (m, centroids) inner products of every sub-vector with its codebook
+        lut = np.einsum('mkd,md->mk', self.codebooks, query)
+        subspaces = np.arange(m)
+        size = len(self.codes) if rows is None else len(rows)
+        scores = np.empty(size, dtype=np.float32)
+        for start, block in _blocks(len(self.codes), rows):
+            codes = self.codes[block]
+            scores[start:start + len(codes)] = lut[subspaces, codes].sum(axis=1)
+        return scores
+
+    def arrays(self):
+        return {'codes': self.codes, 'codebooks': self.codebooks}
+
+
+CODES = {codes.mode: codes for codes in (Float16Codes, Int8Codes, PQCodes)}
+
+
+def train(embeds, mode):
+    return CODES[mode].train(embeds)
+
+
+def save(path, codes):
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, mode=codes.mode, **codes.arrays())
+    os.replace(tmp_path, path)
+
+
+def load(path):
+    data = np.load(path)
+    arrays = {name: data[name] for name in data.files if name != 'mode'}
+    return CODES[str(data['mode'])](**arrays)
+
+
+def nbytes(codes):
+    return sum(array.nbytes for array in codes.arrays().values())
+
+
+class QuantizedIndex(object):
+    """
+    Scores every row on its compressed codes, then re-ranks a shortlist of
+    RERANK_FACTOR times the requested rows with the exact vectors. Only the
+    codes are scanned per query; the exact (memory-mapped) vectors are only
+    read for the shortlist.
+    """
+
+    def __init__(self, embeds, codes, rerank=RERANK_FACTOR):
+        if len(codes.codes) != len(embeds):
+            raise ValueError('Codes do not match the embeddings.')
+        self.embeds = embeds
+        self.codes = codes
+        self.rerank = rerank
+
+    def iter_search(self, query_embed, k, mask=None):
+        rows = None if mask is None else np.flatnonzero(mask)
+        if rows is not None and len(rows) == 0:
+            return
+        scores = self.codes.similarity(query_embed, rows)
+        approx = search.iter_top_k(scores, k * self.rerank)
+        size = max(k, 1) * self.rerank
+        while True:
+            shortlist = np.fromiter(itertools.islice(approx, size),
+                                    dtype=np.int64)
+            if len(shortlist) == 0:
+                return
+            if rows is not None:
+                shortlist = rows[shortlist]
+            # sorted row ids read the memory-mapped vectors sequentially
+            shortlist.sort()
+            exact = search.similarity(self.embeds[shortlist], query_embed)
+            for i in np.argsort(-exact, kind='stable'):
+                yield int(shortlist[i]), float(exact[i])
+            size *= search.GROWTH_FACTOR
+
+    def iter_search_batch(self, query_embeds, ks, masks):
+        return [
+            self.iter_search(query_embed, k, mask)
+            for query_embed, k, mask in zip(query_embeds, ks, masks)
+        ]
+
+
+def report(embeds, modes=MODES, queries=100, k=10, seed=0):
+    """
+    Recall@k against the exact search and memory use of every mode, for
+    queries made of perturbed corpus vectors.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(embeds), min(queries, len(embeds)), replace=False)
+    query_embeds = search.normalize(
+        np.asarray(embeds[np.sort(rows)], dtype=np.float32)
+        + rng.normal(scale=0.05, size=(len(rows), embeds.shape[1])))
+    exact = [set(search.top_k(search.similarity(embeds, q), k))
+             for q in query_embeds]
+    full_bytes = len(embeds) * embeds.shape[1] * 4
+
+    print(f'{"mode":8} {"bytes":>12} {"ratio":>7} '
+          f'{"recall@" + str(k):>10} {"reranked":>10}')
+    print(f'{"float32":8} {full_bytes:12d} {1:7.1f} {1:10.3f} {1:10.3f}')
+    for mode in modes:
+        codes = train(embeds, mode)
+        index = QuantizedIndex(embeds, codes)
+        recall = reranked = 0
+        for q, truth in zip(query_embeds, exact):
+            recall += len(truth & set(search.top_k(codes.similarity(q), k))) / k
+            hits = itertools.islice(index.iter_search(q, k), k)
+            reranked += len(truth & {idx for idx, _ in hits}) / k
+        size = nbytes(codes)
+        print(f'{mode:8} {size:12d} {full_bytes / size:7.1f} '
+              f'{recall / len(exact):10.3f} {reranked / len(exact):10.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build compressed embedding codes for the quantized search.')
+    parser.add_argument('--model', default='scibert-nli', type=str)
+    parser.add_argument('--mode', default='int8', choices=MODES)
+    parser.add_argument('--report', action='store_true',
+                        help='Only print recall and size of every mode.')
+    args = parser.parse_args()
+
+    embeds_path = os.path.join(DATA_PATH, f'{args.model}-embeddings.pkl')
+    if os.path.exists(embeddings.npy_path(embeds_path)):
+        embeds_path = embeddings.npy_path(embeds_path)
+    print(f'Load embeddings from "{embeds_path}"...')
+    embeds = embeddings.load(embeds_path)
+    if args.report:
+        report(embeds)
+    else:
+        path = codes_path(embeds_path, args.mode)
+        save(path, train(embeds, args.mode))
+        print('Codes available in', path)
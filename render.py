@@ -0,0 +1,145 @@
+import gzip
+import json
+import zlib
+
+import numpy as np
+
+import cache
+
+# paper fields after cord_uid and score, in response order
+PAPER_FIELDS = ('title', 'abstract', 'date', 'lang', 'url', 'theme',
+                'sub_theme')
+# fields of the other versions of a paper listed under "versions"
+VERSION_FIELDS = ('date', 'url')
+# bodies smaller than this are sent as they are
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 5
+
+
+class RawJSON(str):
+    """
+    Already encoded JSON, inserted as it is by dumps.
+    """
+
+
+def dumps(value):
+    """
+    json.dumps that splices RawJSON values in. Only the response skeleton
+    goes through here, the papers arrive pre-rendered.
+    """
+    if isinstance(value, RawJSON):
+        return value
+    if isinstance(value, dict):
+        # keys as json.dumps writes them, None -> "null"
+        return '{' + ', '.join(json.dumps('null' if key is None else str(key))
+                               + ': ' + dumps(item)
+                               for key, item in value.items()) + '}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(dumps(item) for item in value) + ']'
+    return json.dumps(value)
+
+
+def fragment(corpus, idx, versions=()):
+    """
+    JSON members of a paper without cord_uid and score, null fields left
+    out and the abstract stripped, e.g. ', "title": "...", "lang": "en"'.
+    Rows of near-duplicates of the paper are listed under "versions".
+    """
+    parts = []
+    for name in PAPER_FIELDS:
+        value = corpus.get(name, idx)
+        if value is None:
+            continue
+        if name == 'abstract':
+            value = value.strip()
+        parts.append(', "' + name + '": ' + json.dumps(value))
+    if len(versions):
+        parts.append(', "versions": '
+                     + json.dumps([version(corpus, row) for row in versions]))
+    return ''.join(parts)
+
+
+def version(corpus, idx):
+    fields = {'cord_uid': corpus.get('cord_uid', idx)}
+    for name in VERSION_FIELDS:
+        value = corpus.get(name, idx)
+        if value is not None:
+            fields[name] = value
+    return fields
+
+
+class Renderer(object):
+    """
+    Renders pages of papers by concatenating per-row fragments, each
+    rendered on first use and kept in a byte bounded LRU cache. Fragments
+    are keyed by data version, so a reload never serves stale rows.
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self.fragments = cache.LRUCache(max_bytes, ttl)
+
+    def fragment(self, data, idx):
+        key = (data.version, idx)
+        value = self.fragments.get(key)
+        if value is None:
+            versions = () if data.duplicates is None \
+                else data.duplicates.versions(idx).tolist()
+            value = fragment(data.corpus, idx, versions)
+            self.fragments.put(key, value)
+        return value
+
+    def papers(self, data, ids, scores):
+        return RawJSON('[' + ', '.join(
+            '{"cord_uid": ' + json.dumps(data.corpus.get('cord_uid', idx))
+            # 0.000 - 10.000
+            + ', "score": ' + json.dumps(round(float(score) * 10, 3))
+            + self.fragment(data, idx) + '}'
+            for idx, score in zip(ids.tolist(), scores)
+        ) + ']')
+
+    def clear(self):
+        self.fragments.clear()
+
+    def stats(self):
+        return self.fragments.stats()
+
+
+def langs(corpus, ids):
+    """
+    Papers per language, counted on the categorical codes; papers without
+    a language count under null.
+    """
+    categories = corpus.categories['lang']
+    counts = np.bincount(np.asarray(corpus.codes['lang'])[ids] + 1,
+                         minlength=len(categories) + 1)
+    return {
+        (categories[code - 1] if code else None): int(counts[code])
+        for code in np.flatnonzero(counts)
+    }
+
+
+def accepted_encoding(header):
+    """
+    'gzip' or 'deflate' if the Accept-Encoding header allows it, else None.
+    """
+    accepted = {}
+    for item in (header or '').split(','):
+        name, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for name in ('gzip', 'deflate'):
+        if accepted.get(name, accepted.get('*', 0)) > 0:
+            return name
+    return None
+
+
+def compress(body, encoding, level=COMPRESS_LEVEL):
+    if encoding == 'gzip':
+        return gzip.compress(body, level)
+    return zlib.compress(body, level)
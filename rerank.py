@@ -0,0 +1,172 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+import cache
+import corpus
+import encoder
+
+DATA_PATH = 'data'
+MODELS_PATH = 'models'
+CORPUS_PATH = os.path.join(DATA_PATH, 'corpus.pkl')
+# query + title + abstract tokens, longer abstracts are cut
+MAX_LENGTH = 256
+BATCH_SIZE = 16
+# rows of a ranking re-ordered by the cross-encoder
+TOP_N = 50
+# seconds a batch of questions may spend re-ranking, beyond that their
+# rankings keep the first-stage order
+TIME_BUDGET = 0.25
+# (data version, query, row) -> cross-encoder score
+CACHE_BYTES = 32 * 1024 * 1024
+CACHE_TTL = None
+
+
+def paper_text(store, idx):
+    return ' '.join(text.strip() for text in (store.get('title', idx),
+                                              store.get('abstract', idx))
+                    if text)
+
+
+class CrossEncoderReranker(object):
+    """
+    Second stage ranking: a cross-encoder reads the query and a paper's
+    title and abstract together and scores their relevance, much slower
+    but more precise than comparing embeddings. Only the head of a ranking
+    is rescored, in batches of pairs of similar token length so little
+    goes to padding. Pair scores are cached.
+    """
+
+    def __init__(self, model_path, quantize=False, max_length=MAX_LENGTH,
+                 batch_size=BATCH_SIZE, cache_bytes=CACHE_BYTES,
+                 cache_ttl=CACHE_TTL):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.model = AutoModelForSequenceClassification.from_pretrained(
+            model_path)
+        if quantize:
+            self.model = encoder.quantize_dynamic(self.model)
+        self.model.eval()
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.cache = cache.LRUCache(cache_bytes, cache_ttl)
+
+    def nbytes(self):
+        return encoder.nbytes(self.model)
+
+    def scores(self, store, keys, deadline=None):
+        """
+        Scores in (0, 1) of (version, query, row) pairs, by key. Pairs
+        still unscored when the next batch would end past the deadline are
+        left out.
+        """
+        scores = {}
+        pending = []
+        for key in dict.fromkeys(keys):
+            score = self.cache.get(key)
+            if score is None:
+                pending.append(key)
+            else:
+                scores[key] = score
+        if not pending:
+            return scores
+
+        features = self.tokenizer([query for _, query, _ in pending],
+                                  [paper_text(store, idx) for _, _, idx in pending],
+                                  truncation='only_second',
+                                  max_length=self.max_length)
+        lengths = np.array([len(ids) for ids in features['input_ids']])
+        order = np.argsort(lengths, kind='stable')
+        # seconds per token of the last batch, to tell if the next one fits
+        token_seconds = 0
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            padded = int(lengths[batch].max()) * len(batch)
+            if deadline is not None and \
+                    time.monotonic() + token_seconds * padded > deadline:
+                break
+            started = time.perf_counter()
+            inputs = self.tokenizer.pad(
+                {name: [values[i] for i in batch]
+                 for name, values in features.items()},
+                return_tensors='pt')
+            no_grad = getattr(torch, 'inference_mode', torch.no_grad)
+            with no_grad():
+                # relevance is the only (or the last) label
+                logits = self.model(**inputs).logits[:, -1]
+            token_seconds = (time.perf_counter() - started) / padded
+            for i, score in zip(batch, torch.sigmoid(logits).tolist()):
+                scores[pending[i]] = score
+                self.cache.put(pending[i], score)
+        return scores
+
+    def rerank(self, store, version, rankings, top_n=TOP_N,
+               budget=TIME_BUDGET):
+        """
+        Re-order the first top_n rows of (query, ids, scores) rankings by
+        cross-encoder score, the rest stays behind them as it was. Returns
+        (ids, scores, reranked) per ranking; a ranking not fully rescored
+        within the budget keeps its first-stage order. The cross-encoder
+        scores are mapped onto the range of the head's first-stage scores,
+        so scores still follow the ranking into the tail.
+        """
+        deadline = time.monotonic() + budget if budget is not None else None
+        heads = [
+            [(version, cache.normalize_query(query), idx)
+             for idx in ids[:top_n].tolist()]
+            for query, ids, _ in rankings
+        ]
+        scores = self.scores(store, [key for head in heads for key in head],
+                             deadline)
+
+        results = []
+        for (_, ids, first), head in zip(rankings, heads):
+            if not head or not all(key in scores for key in head):
+                results.append((ids, first, not head))
+                continue
+            head_scores = np.array([scores[key] for key in head],
+                                   dtype=np.float32)
+            order = np.argsort(-head_scores, kind='stable')
+            # between the first tail score (lowest head score without tail)
+            # and the best first-stage score
+            floor = first[top_n] if len(first) > top_n else first[:top_n].min()
+            head_scores = floor + head_scores * (first[:top_n].max() - floor)
+            results.append((
+                np.concatenate((ids[:top_n][order], ids[top_n:])),
+                np.concatenate((head_scores[order], first[top_n:])),
+                True,
+            ))
+        return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Time the re-ranking of top_n papers for a query, to '
+                    'size TOP_N and TIME_BUDGET on this machine.')
+    parser.add_argument('--model', default='ms-marco-minilm', type=str)
+    parser.add_argument('--corpus', default=CORPUS_PATH, type=str)
+    parser.add_argument('--quantize', action='store_true')
+    parser.add_argument('--top_n', default=TOP_N, type=int)
+    parser.add_argument('--batch_size', default=BATCH_SIZE, type=int)
+    parser.add_argument('query', type=str)
+    args = parser.parse_args()
+
+    store = corpus.load(args.corpus)
+    reranker = CrossEncoderReranker(os.path.join(MODELS_PATH, args.model),
+                                    args.quantize, batch_size=args.batch_size)
+    ids = np.arange(min(args.top_n, len(store)))
+    for run in ('cold', 'cached'):
+        started = time.perf_counter()
+        (ranked, scores, _), = reranker.rerank(
+            store, 0, [(args.query, ids, np.zeros(len(ids), np.float32))],
+            args.top_n, None)
+        print(f'{run}: {len(ids)} papers in '
+              f'{time.perf_counter() - started:.3f} s')
+    # cross-encoder scores, cached by the runs above
+    pairs = reranker.scores(store, [(0, cache.normalize_query(args.query), idx)
+                                    for idx in ranked[:5].tolist()])
+    for score, idx in zip(pairs.values(), ranked[:5]):
+        print(f'{score:.3f}  {store.get("title", idx)}')
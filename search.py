@@ -0,0 +1,109 @@
+import numpy as np
+
+# how much the candidate pool grows when filters reject too many rows
+GROWTH_FACTOR = 4
+# rows upcast at once when scoring reduced precision embeddings
+SCORE_BATCH = 65536
+# below this fraction of selected rows only the selected rows get scored
+SPARSE_MASK = 0.5
+
+
+def normalize(embeds):
+    """
+    Cast embeddings to float32 and scale each row to unit length, so that
+    cosine similarity becomes a plain dot product.
+    """
+    embeds = np.asarray(embeds, dtype=np.float32)
+    norms = np.linalg.norm(embeds, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeds / norms
+
+
+def top_k(scores, k):
+    """
+    Indices of the k highest scores, best first. Only the selected k
+    elements get sorted, the rest of the array is partitioned in O(n).
+    """
+    n = len(scores)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k >= n:
+        idx = np.arange(n)
+    else:
+        idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx], kind='stable')]
+
+
+def iter_top_k(scores, k, growth=GROWTH_FACTOR):
+    """
+    Yield indices in descending score order, selecting k at first and
+    growing the selection only when the caller keeps consuming (e.g. when
+    filters reject most candidates).
+    """
+    n = len(scores)
+    k = max(k, 1)
+    seen = np.zeros(n, dtype=bool)
+    while True:
+        idx = top_k(scores, k)
+        idx = idx[~seen[idx]]
+        seen[idx] = True
+        for i in idx:
+            yield int(i)
+        if k >= n:
+            return
+        k *= growth
+
+
+def iter_search(embeds, query_embed, k, mask=None, scores=None):
+    """
+    Exact search yielding (idx, score) best first. With a boolean mask only
+    the selected rows are ranked; sparse masks also skip scoring the rest.
+    Precomputed scores (e.g. a row of similarity_batch) skip the scoring.
+    """
+    if mask is None:
+        if scores is None:
+            scores = similarity(embeds, query_embed)
+        for idx in iter_top_k(scores, k):
+            yield idx, float(scores[idx])
+        return
+    rows = np.flatnonzero(mask)
+    if len(rows) == 0:
+        return
+    if scores is not None:
+        scores = scores[rows]
+    elif len(rows) < len(embeds) * SPARSE_MASK:
+        scores = similarity(embeds[rows], query_embed)
+    else:
+        scores = similarity(embeds, query_embed)[rows]
+    for i in iter_top_k(scores, k):
+        yield int(rows[i]), float(scores[i])
+
+
+def similarity(embeds, query_embed):
+    """
+    Cosine similarity of a normalized query against normalized embeddings.
+    Reduced precision stores (e.g. float16) are upcast block by block instead
+    of materializing a float32 copy of the whole matrix.
+    """
+    if embeds.dtype == np.float32:
+        return embeds @ query_embed
+    scores = np.empty(len(embeds), dtype=np.float32)
+    for start in range(0, len(embeds), SCORE_BATCH):
+        block = embeds[start:start + SCORE_BATCH].astype(np.float32)
+        scores[start:start + len(block)] = block @ query_embed
+    return scores
+
+
+def similarity_batch(embeds, query_embeds):
+    """
+    Scores of several normalized queries in one matrix-matrix product,
+    shape (queries, rows).
+    """
+    query_embeds = np.asarray(query_embeds, dtype=np.float32)
+    if embeds.dtype == np.float32:
+        return query_embeds @ embeds.T
+    scores = np.empty((len(query_embeds), len(embeds)), dtype=np.float32)
+    for start in range(0, len(embeds), SCORE_BATCH):
+        block = embeds[start:start + SCORE_BATCH].astype(np.float32)
+        scores[:, start:start + len(block)] = query_embeds @ block.T
+    return scores
@@ -0,0 +1,72 @@
+# python -m pytest test_papers_async.py
+import asyncio
+import json
+import threading
+import time
+from urllib.parse import urlencode
+
+from falcon import testing
+
+import batching
+import papers
+import papers_async
+
+HEADERS = {'Authorization': 'ZHANG', 'Account-ID': 'bin'}
+
+
+def simulate_get(path, params, disconnect_after=30):
+    """
+    GET on the ASGI app from a client that stays connected for
+    disconnect_after seconds (falcon's TestClient hangs up right away).
+    """
+    scope = testing.create_scope(path, urlencode(params), headers=HEADERS)
+    emitter = testing.ASGIRequestEventEmitter(
+        disconnect_at=time.time() + disconnect_after)
+    collector = testing.ASGIResponseEventCollector()
+    asyncio.run(papers_async.app(scope, emitter, collector))
+    body = b''.join(event.get('body', b'') for event in collector.events
+                    if event['type'] == 'http.response.body')
+    return collector.status, json.loads(body)
+
+
+def test_answer_error_body(monkeypatch):
+    def ask_question(*args):
+        raise papers.AnswerError('Model biobert-nli is not available.')
+
+    monkeypatch.setattr(papers_async.db, 'start', lambda *args: None)
+    monkeypatch.setattr(papers_async.db, 'ask_question', ask_question)
+    status, body = simulate_get('/papers', {'q': 'corona'})
+    assert status == 725
+    assert body == {'title': 'Answer Engine Error',
+                    'description': 'Model biobert-nli is not available.'}
+
+
+def test_not_ready_error_body(monkeypatch):
+    # never started, the engine has nothing loaded
+    monkeypatch.setattr(papers_async.db, 'start', lambda *args: None)
+    status, body = simulate_get('/papers', {'q': 'corona'})
+    assert status == 503
+    assert body == {'title': 'Not Ready',
+                    'description': 'The answer engine is still loading.'}
+
+
+def test_disconnect_skips_waiting_questions(monkeypatch):
+    release = threading.Event()
+
+    class Engine(object):
+        # busy with an earlier batch until released
+        def ask_questions(self, questions):
+            release.wait()
+            return [None] * len(questions)
+
+    batcher = batching.MicroBatcher(Engine(), max_batch_size=1)
+    batcher.submit('earlier')
+    monkeypatch.setattr(papers_async.db, 'start', lambda *args: None)
+    monkeypatch.setattr(papers_async.papers, 'db', batcher)
+    status, body = simulate_get('/papers', {'q': 'corona'},
+                                disconnect_after=0.1)
+    (question, future), = batcher.queue.queue
+    release.set()
+    assert question[0] == 'corona'
+    assert future.cancelled()
+    assert status == 499